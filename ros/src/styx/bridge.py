@@ -8,11 +8,12 @@ from std_msgs.msg import Float32 as Float
 from std_msgs.msg import Bool
 from sensor_msgs.msg import PointCloud2
 from sensor_msgs.msg import Image
+from sensor_msgs.msg import RegionOfInterest
 import sensor_msgs.point_cloud2 as pcl2
 from std_msgs.msg import Header
 from cv_bridge import CvBridge, CvBridgeError
 
-from styx_msgs.msg import TrafficLight, TrafficLightArray, Lane
+from styx_msgs.msg import TrafficLight, TrafficLightArray, Lane, RegionImage
 import numpy as np
 from PIL import Image as PIL_Image
 from io import BytesIO
@@ -32,7 +33,9 @@ TYPE = {
     'brake_cmd': BrakeCmd,
     'throttle_cmd': ThrottleCmd,
     'path_draw': Lane,
-    'image':Image
+    'image':Image,
+    'roi': RegionOfInterest,
+    'region_image': RegionImage
 }
 
 
@@ -45,11 +48,18 @@ class Bridge(object):
         self.angular_vel = 0.
         self.bridge = CvBridge()
 
+        # Region of the camera image requested by tl_detector, full frames are sent without one. The
+        # request is refreshed with every received frame, the timeout only covers a stalled detector.
+        self.roi = None
+        self.roi_time = 0.
+        self.roi_timeout = rospy.get_param('~roi_timeout', 1.)
+
         self.callbacks = {
             '/vehicle/steering_cmd': self.callback_steering,
             '/vehicle/throttle_cmd': self.callback_throttle,
             '/vehicle/brake_cmd': self.callback_brake,
-	    '/final_waypoints': self.callback_path
+	    '/final_waypoints': self.callback_path,
+            '/image_roi_request': self.callback_roi_request
         }
 
         self.subscribers = [rospy.Subscriber(e.topic, TYPE[e.type], self.callbacks[e.topic])
@@ -177,11 +187,32 @@ class Bridge(object):
     def publish_camera(self, data):
         imgString = data["image"]
         image = PIL_Image.open(BytesIO(base64.b64decode(imgString)))
+
+        roi = self.roi
+        if roi is not None and rospy.get_time() - self.roi_time <= self.roi_timeout:
+            # Only convert and transport the requested region
+            x1 = min(max(roi.x_offset, 0), image.size[0])
+            y1 = min(max(roi.y_offset, 0), image.size[1])
+            x2 = min(roi.x_offset + roi.width, image.size[0])
+            y2 = min(roi.y_offset + roi.height, image.size[1])
+            if x2 > x1 and y2 > y1:
+                region = RegionImage()
+                region.roi = RegionOfInterest(x_offset=x1, y_offset=y1, width=x2 - x1, height=y2 - y1)
+                region.image = self.bridge.cv2_to_imgmsg(np.asarray(image.crop((x1, y1, x2, y2))), encoding="rgb8")
+                region.header = region.image.header
+                self.publishers['image_roi'].publish(region)
+                return
+
         image_array = np.asarray(image)
 
         image_message = self.bridge.cv2_to_imgmsg(image_array, encoding="rgb8")
         self.publishers['image'].publish(image_message)
 
+    def callback_roi_request(self, data):
+        # An empty region releases the request
+        self.roi = data if data.width > 0 and data.height > 0 else None
+        self.roi_time = rospy.get_time()
+
     def callback_steering(self, data):
         self.server('steer', data={'steering_angle': str(data.steering_wheel_angle_cmd)})
 
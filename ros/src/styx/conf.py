@@ -6,6 +6,7 @@ conf = AttrDict({
         {'topic':'/vehicle/throttle_cmd', 'type': 'throttle_cmd', 'name': 'throttle'},
         {'topic':'/vehicle/brake_cmd', 'type': 'brake_cmd', 'name': 'brake'},
 	{'topic':'/final_waypoints', 'type': 'path_draw', 'name': 'path'},
+        {'topic':'/image_roi_request', 'type': 'roi', 'name': 'image_roi_request'},
     ],
     'publishers': [
         {'topic': '/current_pose', 'type': 'pose', 'name': 'current_pose'},
@@ -19,5 +20,6 @@ conf = AttrDict({
         {'topic': '/vehicle/traffic_lights', 'type': 'trafficlights', 'name': 'trafficlights'},
         {'topic': '/vehicle/dbw_enabled', 'type': 'bool', 'name': 'dbw_status'},
         {'topic': '/image_color', 'type': 'image', 'name': 'image'},
+        {'topic': '/image_color_roi', 'type': 'region_image', 'name': 'image_roi'},
     ]
 })
@@ -0,0 +1,68 @@
+import math
+import numpy as np
+
+
+class CameraModel(object):
+    """
+    Pinhole camera model which projects world positions into the camera image.
+    All matrices that only depend on the camera setup are built once.
+    """
+    def __init__(self, image_size, focal_length, pitch=7.0, yaw=0.7, near=1.0, far=100.0):
+        self.image_size = image_size
+
+        n = near  # you may want to adjust this if you want to look closer
+        f = far  # you may want to adjust this if you want to took further
+        t = image_size[1] / (2 * focal_length[1])
+        b = -t
+        r = image_size[0] / (2 * focal_length[0])
+        l = -r
+
+        # http://www.glprogramming.com/red/appendixf.html
+        # proj_mat = np.matrix([[ 2*n/(r-l), 0,         (r+l)/(r-l), 0           ],
+        #                      [ 0,         2*n/(t-b), (t+b)/(t-b), 0           ],
+        #                      [ 0,         0,        -(f+n)/(f-n), -2*f*n/(f-n)],
+        #                      [ 0,         0,        -1,           0           ]]);
+        self.proj_mat = np.array([[-(r + l) / (r - l), -2.0 * n / (r - l), 0.0, 0.0],
+                                  [-(t + b) / (t - b), 0.0, 2.0 * n / (t - b), 0.0],
+                                  [(f + n) / (f - n), 0.0, 0.0, -2.0 * f * n / (f - n)],
+                                  [1.0, 0.0, 0.0, 0.0]])
+
+        # the camera is obviously looking upwards
+        al = pitch * math.pi / 180.0
+        cosa = math.cos(al)
+        sina = math.sin(al)
+        bl = yaw * math.pi / 180.0
+        cosb = math.cos(bl)
+        sinb = math.sin(bl)
+        rotlookat_mat = np.array([[cosa, 0.0, sina, 0.0],
+                                  [0.0, 1.0, 0.0, 0.0],
+                                  [-sina, 0.0, cosa, 0.0],
+                                  [0.0, 0.0, 0.0, 1.0]])
+        rotlookatz_mat = np.array([[cosb, -sinb, 0.0, 0.0],
+                                   [sinb, cosb, 0.0, 0.0],
+                                   [0.0, 0.0, 1.0, 0.0],
+                                   [0.0, 0.0, 0.0, 1.0]])
+        self.lookat_mat = rotlookatz_mat.dot(rotlookat_mat)
+
+    """
+    Projects world positions into the image
+    :param world_to_base: 4x4 matrix transforming world into vehicle coordinates
+    :param positions: Nx3 array of world positions
+    :return: indices of positions inside the view frustum, Kx3 array of their (x, y, scale) in the image
+    """
+    def project(self, world_to_base, positions):
+        points = np.vstack((np.asarray(positions, dtype=np.float64).T, np.ones(len(positions))))
+        transformed = self.lookat_mat.dot(world_to_base).dot(points)
+        projected = self.proj_mat.dot(transformed)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            projected = projected[:3] / projected[3]
+
+        # clip
+        visible = np.flatnonzero(np.all(np.abs(projected) < 1, axis=0))
+
+        image_width, image_height = self.image_size
+        projections = np.empty((len(visible), 3))
+        projections[:, 0] = projected[0, visible] * image_width / 2.0 + image_width / 2.0
+        projections[:, 1] = -projected[1, visible] * image_height / 2.0 + image_height / 2.0
+        projections[:, 2] = 1.0 / transformed[0, visible]
+        return visible, projections
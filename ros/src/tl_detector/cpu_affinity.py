@@ -0,0 +1,46 @@
+import ctypes
+import ctypes.util
+import os
+
+# Number of cpus covered by the affinity mask, matches glibc's cpu_set_t
+CPU_SETSIZE = 1024
+
+
+"""
+Parses a list of cpus
+:param cpus: list of cpu ids or string of comma separated cpu ids and ranges, e.g. "2,3" or "4-7"
+:return: sorted list of cpu ids
+"""
+def parse_cpus(cpus):
+    if isinstance(cpus, (list, tuple)):
+        return sorted(set(int(cpu) for cpu in cpus))
+    cpu_ids = set()
+    for part in str(cpus).split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            cpu_ids.update(range(int(first), int(last) + 1))
+        elif part:
+            cpu_ids.add(int(part))
+    return sorted(cpu_ids)
+
+
+"""
+Restricts the calling thread to the given cpus. Threads started by it
+afterwards inherit the affinity, threads which already exist keep theirs.
+:param cpus: list of cpu ids
+"""
+def set_cpu_affinity(cpus):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return
+
+    # Python 2 has no affinity API, so go through libc
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    bits_per_word = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // bits_per_word))()
+    for cpu in cpus:
+        mask[cpu // bits_per_word] |= 1 << (cpu % bits_per_word)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
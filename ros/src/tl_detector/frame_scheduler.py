@@ -0,0 +1,37 @@
+class FrameScheduler(object):
+    """
+    Decides which camera frames get classified. Without an upcoming stop line no
+    frame is classified, otherwise the classification rate rises from min_rate
+    at far_dist to max_rate at near_dist from the stop line.
+    """
+    def __init__(self, min_rate=2.0, max_rate=30.0, near_dist=20.0, far_dist=100.0):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.near_dist = near_dist
+        self.far_dist = far_dist
+        self.last_time = 0.0
+        self.frames = 0
+        self.skipped = 0
+
+    def get_rate(self, stop_line_dist):
+        fraction = (stop_line_dist - self.near_dist) / max(self.far_dist - self.near_dist, 1e-6)
+        fraction = max(0.0, min(fraction, 1.0))
+        return self.max_rate + fraction * (self.min_rate - self.max_rate)
+
+    """
+    Get whether frame should be processed
+    :param now: frame time in seconds
+    :param stop_line_dist: distance to upcoming stop line (None if there is none in range)
+    :return: True if frame is due for classification
+    """
+    def should_process(self, now, stop_line_dist):
+        self.frames += 1
+        if stop_line_dist is None or now - self.last_time < 1.0 / self.get_rate(stop_line_dist):
+            self.skipped += 1
+            return False
+        self.last_time = now
+        return True
+
+    # Fraction of frames should_process declined
+    def get_skip_ratio(self):
+        return float(self.skipped) / self.frames if self.frames > 0 else 0.0
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Throughput benchmark of TLClassifier, which needs no running ROS system.
+
+Classifies all images of a directory for a number of iterations and reports
+images/sec, per call latency percentiles, peak RSS and cold start time as JSON.
+
+python benchmark.py --image_dir=./training/samples/red --batch_size=4 --iterations=20
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import cv2
+import numpy as np
+import tensorflow as tf
+from color_cascade import ColorCascade
+from result_cache import ResultCache, DEFAULT_TTL
+from tl_classifier import TLClassifier
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def load_images(image_dir, max_images):
+    images = []
+    for file_name in sorted(os.listdir(image_dir)):
+        if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+            bgr = cv2.imread(os.path.join(image_dir, file_name))
+            if bgr is not None:
+                images.append(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+        if 0 < max_images <= len(images):
+            break
+    return images
+
+
+def run_benchmark(args):
+    model = \
+        {
+            'input_width': args.input_size,
+            'input_height': args.input_size,
+            'input_depth': 3,
+            'resized_input_tensor_name': "input:0",
+            'output_tensor_name': "final_result:0",
+            'model_file_name': args.model_file,
+            'labels_file_name': args.labels_file,
+            'input_mean': 127.5,
+            'input_std': 127.5,
+            'in_graph_preprocessing': args.in_graph_preprocessing
+        }
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads,
+                                    inter_op_parallelism_threads=args.inter_op_threads)
+
+    images = load_images(args.image_dir, args.max_images)
+    if not images:
+        raise ValueError('No images found in %s' % args.image_dir)
+
+    # Cold start covers loading the graph, creating the session and warm up
+    start = time.time()
+    result_cache = ResultCache(args.result_cache_size, args.result_cache_ttl) if args.result_cache_size > 0 else None
+    color_cascade = ColorCascade() if args.color_cascade else None
+    classifier = TLClassifier(model, None, False, session_config=session_config, result_cache=result_cache,
+                              color_cascade=color_cascade)
+    cold_start = time.time() - start
+
+    batches = [images[i:i + args.batch_size] for i in range(0, len(images), args.batch_size)]
+    latencies = []
+    try:
+        start = time.time()
+        for _ in range(args.iterations):
+            for batch in batches:
+                call_start = time.time()
+                classifier.get_classifications(batch)
+                latencies.append(time.time() - call_start)
+        duration = time.time() - start
+    finally:
+        classifier.close()
+
+    latencies = np.array(latencies) * 1000.0
+    return {
+        'model_file': args.model_file,
+        'images': len(images),
+        'batch_size': args.batch_size,
+        'iterations': args.iterations,
+        'intra_op_threads': args.intra_op_threads,
+        'inter_op_threads': args.inter_op_threads,
+        'in_graph_preprocessing': args.in_graph_preprocessing,
+        'result_cache_size': args.result_cache_size,
+        'result_cache_hit_rate': result_cache.get_hit_rate() if result_cache is not None else 0.0,
+        'color_cascade': args.color_cascade,
+        'cascade_settled_ratio': color_cascade.get_settled_ratio() if color_cascade is not None else 0.0,
+        'cascade_agreement': color_cascade.get_agreement() if color_cascade is not None else 1.0,
+        'images_per_sec': len(images) * args.iterations / duration,
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p95_ms': float(np.percentile(latencies, 95)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+        'latency_max_ms': float(latencies.max()),
+        'cold_start_s': cold_start,
+        # ru_maxrss is reported in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TLClassifier throughput')
+    parser.add_argument('--image_dir', type=str, required=True, help='Directory of images to classify')
+    parser.add_argument('--model_file', type=str, default='graph.pb', help='Frozen graph to benchmark')
+    parser.add_argument('--labels_file', type=str, default='labels.txt', help='Labels of the graph')
+    parser.add_argument('--input_size', type=int, default=128, help='Width and height of the graph input')
+    parser.add_argument('--batch_size', type=int, default=1, help='Images per classification call')
+    parser.add_argument('--iterations', type=int, default=10, help='How often all images are classified')
+    parser.add_argument('--max_images', type=int, default=0, help='Limit number of images (0 for all)')
+    parser.add_argument('--intra_op_threads', type=int, default=0, help='TF intra op threads (0 for default)')
+    parser.add_argument('--inter_op_threads', type=int, default=0, help='TF inter op threads (0 for default)')
+    parser.add_argument('--in_graph_preprocessing', action='store_true',
+                        help='Resize and normalize inside the graph')
+    parser.add_argument('--result_cache_size', type=int, default=0,
+                        help='Entries of the result cache for near-identical crops (0 disables it)')
+    parser.add_argument('--result_cache_ttl', type=float, default=DEFAULT_TTL,
+                        help='Seconds a cached result stays valid')
+    parser.add_argument('--color_cascade', action='store_true',
+                        help='Settle obvious crops by their color before the network')
+    parser.add_argument('--output', type=str, default='', help='Write JSON result to file instead of stdout')
+    args = parser.parse_args()
+
+    result = json.dumps(run_benchmark(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
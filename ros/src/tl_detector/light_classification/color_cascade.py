@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+
+# Hue ranges of lit lamps, OpenCV scales hue to [0, 180)
+HUE_RANGES = \
+    {
+        'red': [(0, 10), (160, 180)],
+        'yellow': [(15, 35)],
+        'green': [(45, 100)]
+    }
+
+
+class ColorCascade(object):
+    """
+    Cheap first stage in front of the network. Counts bright, saturated pixels per
+    lamp color in HSV space and settles crops with no lit lamp or with a single
+    clearly dominating color. All other crops are left to the network.
+    Every verify_interval-th settled crop is classified by the network as well,
+    to keep statistics of how often both stages agree.
+    """
+    def __init__(self, min_saturation=120, min_value=180, min_lit_fraction=0.003, max_unlit_fraction=0.0005,
+                 dominance_ratio=10.0, verify_interval=10):
+        self.min_saturation = min_saturation
+        self.min_value = min_value
+        self.min_lit_fraction = min_lit_fraction
+        self.max_unlit_fraction = max_unlit_fraction
+        self.dominance_ratio = dominance_ratio
+        self.verify_interval = verify_interval
+        self.labels = sorted(HUE_RANGES.keys())
+        self.hue_lut = np.zeros((len(self.labels), 256), np.int64)
+        for ind, label in enumerate(self.labels):
+            for first, last in HUE_RANGES[label]:
+                self.hue_lut[ind, first:last] = 1
+
+        self.settled = 0
+        self.passed = 0
+        self.verified = 0
+        self.agreed = 0
+
+    """
+    Classifies image by its color mass
+    :param image: rgb image
+    :return: label ('none' or one of HUE_RANGES) or None if the crop is ambiguous
+    """
+    def classify(self, image):
+        hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+        lit = (hsv[:, :, 1] >= self.min_saturation) & (hsv[:, :, 2] >= self.min_value)
+        hues = hsv[:, :, 0][lit]
+        pixel_count = float(lit.size)
+
+        label = None
+        if hues.size <= self.max_unlit_fraction * pixel_count:
+            label = 'none'
+        elif hues.size >= self.min_lit_fraction * pixel_count:
+            counts = np.bincount(hues, minlength=256)
+            color_counts = np.dot(self.hue_lut, counts)
+            top = np.argmax(color_counts)
+            others = color_counts.sum() - color_counts[top]
+            if color_counts[top] >= self.min_lit_fraction * pixel_count and \
+                    color_counts[top] >= self.dominance_ratio * others:
+                label = self.labels[top]
+
+        if label is None:
+            self.passed += 1
+        else:
+            self.settled += 1
+        return label
+
+    """
+    Whether a settled crop should be classified by the network as well
+    :return: True for every verify_interval-th settled crop
+    """
+    def should_verify(self):
+        return self.verify_interval > 0 and self.settled % self.verify_interval == 0
+
+    """
+    Records whether the network agreed with a settled crop
+    :param cascade_result: result of the cascade
+    :param network_result: result of the network for the same crop
+    """
+    def add_verification(self, cascade_result, network_result):
+        self.verified += 1
+        if cascade_result == network_result:
+            self.agreed += 1
+
+    def get_settled_ratio(self):
+        total = self.settled + self.passed
+        return float(self.settled) / total if total > 0 else 0.0
+
+    def get_agreement(self):
+        return float(self.agreed) / self.verified if self.verified > 0 else 1.0
@@ -0,0 +1,109 @@
+import collections
+import os
+import sys
+import threading
+import traceback
+import cv2
+import numpy as np
+
+DROP_NEWEST = 'newest'
+DROP_OLDEST = 'oldest'
+BLOCK = 'block'
+
+
+class ImageSink(object):
+    """
+    Writes rgb images to disk on a background thread, so capturing data does not
+    stall perception. The queue is bounded, when it is full either the incoming
+    image (DROP_NEWEST), the oldest queued image (DROP_OLDEST) is dropped or the
+    caller waits (BLOCK). Images must not be modified after being handed over.
+    Images which fail to be written are reported through log_error and count as dropped.
+    """
+    def __init__(self, max_queue_size=32, drop_policy=DROP_NEWEST, image_format='png', png_compression=3,
+                 jpeg_quality=90, log_error=None):
+        self.max_queue_size = max_queue_size
+        self.drop_policy = drop_policy
+        self.log_error = log_error if log_error is not None else lambda msg: sys.stderr.write(msg + '\n')
+        if image_format == 'jpg':
+            self.extension = '.jpg'
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        else:
+            self.extension = '.png'
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.thread = None
+        self.closed = False
+        self.written = 0
+        self.dropped = 0
+
+    """
+    Queue image for writing
+    :param file_name: file name without extension, which is chosen by the image format
+    :param image: rgb image
+    :param rectangle: optional ((x1, y1), (x2, y2), color) rectangle to draw onto the written image
+    :return: True if image got queued
+    """
+    def write(self, file_name, image, rectangle=None):
+        with self.cond:
+            if self.closed:
+                return False
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='image_sink')
+                self.thread.daemon = True
+                self.thread.start()
+
+            while len(self.queue) >= self.max_queue_size:
+                if self.drop_policy == DROP_OLDEST:
+                    self.queue.popleft()
+                elif self.drop_policy == BLOCK:
+                    self.cond.wait()
+                    continue
+                else:
+                    self.dropped += 1
+                    return False
+                self.dropped += 1
+
+            self.queue.append((file_name + self.extension, image, rectangle))
+            self.cond.notify_all()
+        return True
+
+    # Writer loop
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                file_name, image, rectangle = self.queue.popleft()
+                self.cond.notify_all()
+
+            try:
+                self.write_image(file_name, image, rectangle)
+                self.written += 1
+            except Exception:
+                # Keep writer alive, otherwise the queue never drains and blocking writers hang
+                with self.cond:
+                    self.dropped += 1
+                self.log_error('Failed to write image %s:\n%s' % (file_name, traceback.format_exc()))
+
+    def write_image(self, file_name, image, rectangle):
+        directory = os.path.dirname(file_name)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        bgr = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_RGB2BGR)
+        if rectangle is not None:
+            cv2.rectangle(bgr, rectangle[0], rectangle[1], rectangle[2])
+        if not cv2.imwrite(file_name, bgr, self.params):
+            raise IOError('cv2.imwrite failed')
+
+    # Writes remaining images and stops writer thread
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,84 @@
+import binascii
+import collections
+import time
+import cv2
+import numpy as np
+
+DEFAULT_MAX_SIZE = 64  # Number of cached results
+DEFAULT_TTL = 1.0  # Seconds a cached result stays valid
+DEFAULT_MAX_DISTANCE = 4  # Number of hash bits a near duplicate may differ in
+
+
+class ResultCache(object):
+    """
+    LRU cache of classification results keyed by a difference hash of the
+    downscaled crop. Crops whose hash differs in at most max_distance bits
+    from a cached one reuse its result, until it is older than ttl seconds.
+    Expired entries are evicted when a lookup comes across them.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, max_distance=DEFAULT_MAX_DISTANCE, hash_size=8):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    """
+    Get difference hash of an image, computed per color channel so lamps of
+    different colors at the same position do not collide
+    :param image: rgb image
+    :return: hash as integer
+    """
+    def get_hash(self, image):
+        small = cv2.resize(image, (self.hash_size + 1, self.hash_size), interpolation=cv2.INTER_AREA)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        return int(binascii.hexlify(np.packbits(bits).tobytes()), 16)
+
+    """
+    Get cached result for an image hash
+    :param key: hash of the image
+    :return: cached result, None if there is none
+    """
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and now - entry[1] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None and self.max_distance > 0:
+            # Look for a near duplicate, expired entries passed on the way only slow down later searches
+            expired = []
+            for other_key, other_entry in self.entries.items():
+                if now - other_entry[1] > self.ttl:
+                    expired.append(other_key)
+                elif bin(key ^ other_key).count('1') <= self.max_distance:
+                    key, entry = other_key, other_entry
+                    break
+            for expired_key in expired:
+                del self.entries[expired_key]
+        if entry is not None:
+            # Mark as recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    """
+    Store result for an image hash, evicting the least recently used entry when full
+    :param key: hash of the image
+    :param result: classification result
+    """
+    def put(self, key, result):
+        if key in self.entries:
+            del self.entries[key]
+        self.entries[key] = (result, time.time())
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total > 0 else 0.0
@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+import numpy as np
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.add_sample(self.name, time.time() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """
+    Measures the duration of named pipeline stages and keeps the most recent
+    window_size samples per stage to report latency percentiles. A disabled
+    timer hands out a shared no-op stage and records nothing.
+    """
+    def __init__(self, enabled=True, window_size=512):
+        self.enabled = enabled
+        self.window_size = window_size
+        self.lock = threading.Lock()
+        self.samples = collections.OrderedDict()
+        self.counts = {}
+
+    """
+    Get context manager measuring one stage
+    :param name: name of stage
+    """
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def add_sample(self, name, duration):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = np.zeros(self.window_size)
+                self.counts[name] = 0
+            self.samples[name][self.counts[name] % self.window_size] = duration
+            self.counts[name] += 1
+
+    """
+    Get latency percentiles of all stages
+    :param percentiles: percentiles to compute
+    :return: list of (stage name, sample count, [percentile values in seconds]) tuples
+    """
+    def get_percentiles(self, percentiles=(50, 95, 99)):
+        with self.lock:
+            windows = [(name, self.counts[name], samples[:min(self.counts[name], self.window_size)].copy())
+                       for name, samples in self.samples.items()]
+        return [(name, count, list(np.percentile(window, percentiles))) for name, count, window in windows]
@@ -1,39 +1,129 @@
-from styx_msgs.msg import TrafficLight
 import tensorflow as tf
 import scipy.misc
 import cv2
 import numpy as np
 import time
-import os
-import rospy
+from image_sink import ImageSink
+from stage_timer import StageTimer
+
+try:
+    from styx_msgs.msg import TrafficLight
+except ImportError:
+    # Classifier is used without a catkin workspace, e.g. by benchmark.py, ground truth is only needed for training
+    TrafficLight = None
+
+
+def add_crop_preprocessing(input_width, input_height, input_depth, input_mean, input_std):
+    """Adds operations that resize and normalize uint8 crops to the graph.
+    Same steps as add_jpeg_decoding in training/retrain.py, but for a batch of
+    raw crops padded to a common size, each given by its normalized box.
+
+    Returns:
+        Tensors for the crops and boxes to feed, and the output of the preprocessing steps.
+    """
+    crop_data = tf.placeholder(tf.uint8, [None, None, None, input_depth], name='CropInput')
+    crop_boxes = tf.placeholder(tf.float32, [None, 4], name='CropBoxes')
+    box_ind = tf.range(tf.shape(crop_boxes)[0])
+    resized_image = tf.image.crop_and_resize(crop_data, crop_boxes, box_ind, [input_height, input_width])
+    offset_image = tf.subtract(resized_image, input_mean)
+    mul_image = tf.multiply(offset_image, 1.0 / input_std)
+    return crop_data, crop_boxes, mul_image
+
 
 class TLClassifier(object):
-    def __init__(self, model_info=None, class_mapping=None, collect_training_data=False):
+    def __init__(self, model_info=None, class_mapping=None, collect_training_data=False, image_sink=None,
+                 stage_timer=None, session_config=None, result_cache=None, color_cascade=None, log_info=None):
         self.model_info = model_info
+        # Optional callable like rospy.loginfo reporting every prediction
+        self.log_info = log_info
         self.class_mapping = class_mapping
         self.collect_training_data = collect_training_data
         self.count = 0
 
+        # Images are written in the background, an own sink is used if none is shared
+        self.owns_image_sink = image_sink is None
+        self.image_sink = ImageSink() if image_sink is None else image_sink
+        self.stage_timer = StageTimer(False) if stage_timer is None else stage_timer
+        # Optional cache reusing results of near-identical crops, disabled if None
+        self.result_cache = result_cache
+        # Optional color stage settling obvious crops before the network, disabled if None
+        self.color_cascade = color_cascade
+
         if self.model_info is not None:
+            # Set input format
+            self.input_size = (self.model_info['input_width'], self.model_info['input_height'])
+            self.input_mean = self.model_info['input_mean']
+            self.input_std = self.model_info['input_std']
+            self.in_graph_preprocessing = self.model_info.get('in_graph_preprocessing', False)
+
             # Load the persisted model into default graph
             self.graph = tf.Graph()
             with self.graph.as_default():
                 with tf.gfile.FastGFile(model_info['model_file_name'], 'rb') as f:
                     graph_def = tf.GraphDef()
                     graph_def.ParseFromString(f.read())
+                if self.in_graph_preprocessing:
+                    # Feed model from resize and normalization ops taking raw crops
+                    self.crop_tensor, self.boxes_tensor, preprocessed = add_crop_preprocessing(
+                        self.input_size[0], self.input_size[1], self.model_info['input_depth'],
+                        self.input_mean, self.input_std)
+                    tf.import_graph_def(graph_def, name='',
+                                        input_map={self.model_info['resized_input_tensor_name']: preprocessed})
+                else:
                     tf.import_graph_def(graph_def, name='')
 
-            # Set input format
-            self.input_size = (self.model_info['input_width'], self.model_info['input_height'])
-            self.input_mean = self.model_info['input_mean']
-            self.input_std = self.model_info['input_std']
-
             # Load the labels
             self.labels = [line.rstrip() for line in tf.gfile.GFile(self.model_info['labels_file_name'])]
 
+            # Keep one session open for the lifetime of the classifier
+            self.sess = tf.Session(graph=self.graph, config=session_config)
+            self.input_tensor = self.graph.get_tensor_by_name(self.model_info['resized_input_tensor_name'])
+            self.output_tensor = self.graph.get_tensor_by_name(self.model_info['output_tensor_name'])
+
+            # Graphs exported with a fixed batch dimension can only classify one image per run
+            self.max_batch_size = self.input_tensor.get_shape().as_list()[0]
+
+            # Warm up, so first real frame does not pay for graph setup
+            dummy_image = np.zeros((self.input_size[1], self.input_size[0], self.model_info['input_depth']), np.uint8)
+            self.sess.run(self.output_tensor, self.get_feed([dummy_image]))
+
+    """Prepares the feed for classifying a batch of images
+    Args:
+        images (list): rgb images of arbitrary size
+    Returns:
+        dict: feed for the session
+    """
+    def get_feed(self, images):
+        if self.in_graph_preprocessing:
+            # Hand over the raw crops, resize and normalization is done by the graph
+            if len(images) == 1:
+                crop_data = images[0][np.newaxis]
+            else:
+                crop_data = np.zeros((len(images), max(image.shape[0] for image in images),
+                                      max(image.shape[1] for image in images), images[0].shape[2]), np.uint8)
+                for ind, image in enumerate(images):
+                    crop_data[ind, :image.shape[0], :image.shape[1]] = image
+            height = max(crop_data.shape[1] - 1, 1)
+            width = max(crop_data.shape[2] - 1, 1)
+            boxes = [[0.0, 0.0, (image.shape[0] - 1) / float(height), (image.shape[1] - 1) / float(width)]
+                     for image in images]
+            return {self.crop_tensor: crop_data, self.boxes_tensor: boxes}
+
+        input_images = []
+        for image in images:
+            input_image = scipy.misc.imresize(image, self.input_size, 'bilinear')
+            input_images.append((input_image.astype(np.float32) - self.input_mean) / self.input_std)
+        return {self.input_tensor: input_images}
 
-    @staticmethod
-    def save_training_img(image, state):
+    def close(self):
+        if self.model_info is not None and self.sess is not None:
+            self.sess.close()
+            self.sess = None
+        if self.owns_image_sink:
+            self.image_sink.close()
+
+
+    def save_training_img(self, image, state):
         if state == TrafficLight.GREEN:
             tl_color = "Green"
         elif state == TrafficLight.YELLOW:
@@ -43,14 +133,8 @@ class TLClassifier(object):
         else:
             tl_color = "Unknown"
 
-        directory = "gt/{}".format(tl_color)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
         time_str = time.strftime("%Y%m%d-%H%M%S")
-        file_name = directory + "/img_{}.png".format(time_str)
-        bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(file_name, bgr)
+        self.image_sink.write("gt/{}/img_{}".format(tl_color, time_str), image)
 
 
     """Determines the color of the traffic light in the image
@@ -61,47 +145,104 @@ class TLClassifier(object):
         int: ID of traffic light color (specified in styx_msgs/TrafficLight)
     """
     def get_classification(self, image, state=None):
-        if self.collect_training_data and state is not None:
-            # Save labeled image for training
-            self.save_training_img(image, state)
-            return state
-        elif self.model_info is not None:
+        return self.get_classifications([image], [state])[0]
+
+    """Determines the colors of several traffic lights with a single batched inference
+    Args:
+        images (list): images each containing a traffic light
+        states (list): Current states of traffic lights (ground truth only used for training)
+    Returns:
+        list: ID of traffic light color (specified in styx_msgs/TrafficLight) for each image
+    """
+    def get_classifications(self, images, states=None):
+        if states is None:
+            states = [None] * len(images)
+        results = [None] * len(images)
+
+        batch_inds = []
+        cache_keys = {}
+        cascade_results = {}
+        for ind, (image, state) in enumerate(zip(images, states)):
+            if self.collect_training_data and state is not None:
+                # Save labeled image for training
+                self.save_training_img(image, state)
+                results[ind] = state
+            elif self.model_info is not None:
+                if self.color_cascade is not None:
+                    with self.stage_timer.stage('cascade'):
+                        label = self.color_cascade.classify(image)
+                    if label is not None:
+                        results[ind] = self.get_label_result(label)
+                        if not self.color_cascade.should_verify():
+                            continue
+                        # Let the network classify it as well to track agreement
+                        cascade_results[ind] = results[ind]
+                if self.result_cache is not None and ind not in cascade_results:
+                    with self.stage_timer.stage('cache_lookup'):
+                        cache_keys[ind] = self.result_cache.get_hash(image)
+                        results[ind] = self.result_cache.get(cache_keys[ind])
+                    if results[ind] is not None:
+                        continue
+                batch_inds.append(ind)
+
+        if batch_inds:
+            # Preprocess
+            with self.stage_timer.stage('preprocess'):
+                batch_size = self.max_batch_size or len(batch_inds)
+                feeds = [self.get_feed([images[ind] for ind in batch_inds[i:i + batch_size]])
+                         for i in range(0, len(batch_inds), batch_size)]
 
-            # No clear detection
+            # Classifiy
+            with self.stage_timer.stage('inference'):
+                predictions = []
+                for feed in feeds:
+                    predictions.extend(self.sess.run(self.output_tensor, feed))
+
+            for ind, prediction in zip(batch_inds, predictions):
+                results[ind] = self.interpret_prediction(prediction, images[ind], states[ind])
+                if ind in cache_keys:
+                    self.result_cache.put(cache_keys[ind], results[ind])
+                if ind in cascade_results:
+                    self.color_cascade.add_verification(cascade_results[ind], results[ind])
+        return results
+
+    """Maps a label to the result reported for it
+    Args:
+        label (str): label of the model or 'none'
+    Returns:
+        int: ID of traffic light color if a class mapping is given, otherwise index of the label (-1 for none)
+    """
+    def get_label_result(self, label):
+        if self.class_mapping:
+            return self.class_mapping[label]
+        return self.labels.index(label) if label in self.labels else -1
+
+    def interpret_prediction(self, predictions, image, state=None):
+        # No clear detection
+        if self.class_mapping:
+            result = self.class_mapping['none']
+        else:
+            result = -1
+
+        top_k = predictions.argsort()[-2:][::-1]
+        top_class = top_k[0]
+
+        # TODO remove debugging output
+        #for node_id in top_k:
+        #    print('%s (score = %.5f)' % (self.labels[node_id], predictions[node_id]))
+        if self.log_info is not None:
+            self.log_info('%s (score = %.5f)' % (self.labels[top_class], predictions[top_class]))
+
+        if predictions[top_class] > 0.25 and predictions[top_class] > predictions[top_k[1]] + 0.1:
             if self.class_mapping:
-                result = self.class_mapping['none']
+                result = self.class_mapping[self.labels[top_class]]
             else:
-                result = -1
-
-            with tf.Session(graph=self.graph) as sess:
-                # Preprocess
-                input_image = scipy.misc.imresize(image, self.input_size, 'bilinear')
-                input_image = np.squeeze((input_image.astype('Float32') - self.input_mean) / self.input_std)
-
-                # Classifiy
-                result_tensor = sess.graph.get_tensor_by_name(self.model_info['output_tensor_name'])
-                predictions, = sess.run(result_tensor, {self.model_info['resized_input_tensor_name']: [input_image]})
-                top_k = predictions.argsort()[-2:][::-1]
-                top_class = top_k[0]
-
-                # TODO remove debugging output
-                #for node_id in top_k:
-                #    print('%s (score = %.5f)' % (self.labels[node_id], predictions[node_id]))
-                rospy.loginfo('%s (score = %.5f)' % (self.labels[top_class], predictions[top_class]))
-
-                if predictions[top_class] > 0.25 and predictions[top_class] > predictions[top_k[1]] + 0.1:
-                    if self.class_mapping:
-                        result = self.class_mapping[self.labels[top_class]]
-                    else:
-                        result = top_class
-                if state is not None and result != state:
-                    bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                    if not os.path.exists('gt'):
-                        os.makedirs('gt')
-                    cv2.imwrite('gt/%d_Detected_%d_as_%d.png' % (self.count, state, result), bgr)
-                    self.count += 1
-
-            return result
+                result = top_class
+        if state is not None and result != state:
+            self.image_sink.write('gt/%d_Detected_%d_as_%d' % (self.count, state, result), image)
+            self.count += 1
+
+        return result
 
 
 def test_file(file_name, classifier):
@@ -138,3 +279,4 @@ if __name__ == '__main__':
     test_file("test_red.png", classifier)
     test_file("test_yellow.png", classifier)
     test_file("test_green.png", classifier)
+    classifier.close()
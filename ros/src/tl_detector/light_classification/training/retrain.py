@@ -97,11 +97,13 @@ from __future__ import print_function
 import argparse
 from datetime import datetime
 import hashlib
+import json
 import os.path
 import random
 import re
 import sys
 import tarfile
+import time
 
 import numpy as np
 from six.moves import urllib
@@ -110,8 +112,14 @@ import tensorflow as tf
 from tensorflow.python.framework import graph_util
 from tensorflow.python.framework import tensor_shape
 from tensorflow.python.platform import gfile
+from tensorflow.python.tools import optimize_for_inference_lib
 from tensorflow.python.util import compat
 
+try:
+  from tensorflow.tools.graph_transforms import TransformGraph
+except ImportError:
+  TransformGraph = None
+
 FLAGS = None
 
 # These are all parameters that are tied to the particular model architecture
@@ -830,6 +838,166 @@ def save_graph_to_file(sess, graph, graph_file_name):
   return
 
 
+def optimize_graph_for_inference(graph_def, input_node_name, output_node_name):
+  """Strips training-only nodes and folds constants and batch norms.
+
+  Uses the graph transform tool if it is available, otherwise falls back to
+  optimize_for_inference, which does not fold constants.
+
+  Args:
+    graph_def: Frozen GraphDef to optimize.
+    input_node_name: Name of the node images are fed into.
+    output_node_name: Name of the classification output node.
+
+  Returns:
+    Optimized GraphDef.
+  """
+  if TransformGraph is not None:
+    return TransformGraph(graph_def, [input_node_name], [output_node_name], [
+        'strip_unused_nodes', 'remove_nodes(op=Identity, op=CheckNumerics)',
+        'fold_constants(ignore_errors=true)', 'fold_batch_norms',
+        'fold_old_batch_norms', 'sort_by_execution_order'])
+  tf.logging.warning('Graph transforms not available, constants are not '
+                     'folded')
+  return optimize_for_inference_lib.optimize_for_inference(
+      graph_def, [input_node_name], [output_node_name],
+      tf.float32.as_datatype_enum)
+
+
+def quantize_graph_weights(graph_def, input_node_name, output_node_name):
+  """Stores large float constants as 8 bit values, dequantized at run time.
+
+  Uses the quantize_weights transform of the graph transform tool.
+
+  Args:
+    graph_def: Frozen GraphDef to quantize.
+    input_node_name: Name of the node images are fed into.
+    output_node_name: Name of the classification output node.
+
+  Returns:
+    GraphDef with quantized weights, None if graph transforms are not
+    available.
+  """
+  if TransformGraph is None:
+    tf.logging.warning('Graph transforms not available, weights are not '
+                       'quantized')
+    return None
+  return TransformGraph(graph_def, [input_node_name], [output_node_name],
+                        ['quantize_weights'])
+
+
+def evaluate_graph(graph_def, image_lists, image_dir, decode_sess,
+                   jpeg_data_tensor, decoded_image_tensor, model_info):
+  """Measures accuracy and latency of a frozen graph on the test images.
+
+  Args:
+    graph_def: Frozen GraphDef taking images as input.
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the images.
+    decode_sess: Session holding the JPEG decoding ops.
+    jpeg_data_tensor: Input tensor for jpeg data from file.
+    decoded_image_tensor: Output of decoding and resizing the image.
+    model_info: Dictionary of information about the model architecture.
+
+  Returns:
+    Dictionary with accuracy, latency percentiles and number of test images.
+  """
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name='')
+  input_tensor = graph.get_tensor_by_name(
+      model_info['resized_input_tensor_name'])
+  output_tensor = graph.get_tensor_by_name(FLAGS.final_tensor_name + ':0')
+
+  latencies = []
+  correct = 0
+  with tf.Session(graph=graph) as sess:
+    # Warm up, so graph setup does not count as latency
+    sess.run(output_tensor, {input_tensor: np.zeros(
+        (1, model_info['input_height'], model_info['input_width'],
+         model_info['input_depth']))})
+    for label_index, label_name in enumerate(image_lists.keys()):
+      for image_index in range(len(image_lists[label_name]['testing'])):
+        image_path = get_image_path(image_lists, label_name, image_index,
+                                    image_dir, 'testing')
+        image_data = gfile.FastGFile(image_path, 'rb').read()
+        input_values = decode_sess.run(decoded_image_tensor,
+                                       {jpeg_data_tensor: image_data})
+        start = time.time()
+        predictions = sess.run(output_tensor, {input_tensor: input_values})
+        latencies.append(time.time() - start)
+        correct += int(np.argmax(predictions) == label_index)
+
+  if not latencies:
+    return {'accuracy': 0.0, 'latency_p50_ms': 0.0, 'latency_p95_ms': 0.0,
+            'test_images': 0}
+  return {
+      'accuracy': 100.0 * correct / len(latencies),
+      'latency_p50_ms': 1000.0 * np.percentile(latencies, 50),
+      'latency_p95_ms': 1000.0 * np.percentile(latencies, 95),
+      'test_images': len(latencies),
+  }
+
+
+def export_inference_graphs(sess, image_lists, jpeg_data_tensor,
+                            decoded_image_tensor, model_info):
+  """Writes inference optimized variants of the trained graph and reports
+  their accuracy and latency on the test images.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    jpeg_data_tensor: Input tensor for jpeg data from file.
+    decoded_image_tensor: Output of decoding and resizing the image.
+    model_info: Dictionary of information about the model architecture.
+  """
+  with gfile.FastGFile(FLAGS.output_graph, 'rb') as f:
+    frozen_graph_def = tf.GraphDef()
+    frozen_graph_def.ParseFromString(f.read())
+  input_node_name = model_info['resized_input_tensor_name'].split(':')[0]
+  optimized_graph_def = optimize_graph_for_inference(
+      frozen_graph_def, input_node_name, FLAGS.final_tensor_name)
+
+  base_name = os.path.splitext(FLAGS.output_graph)[0]
+  variants = [('frozen', FLAGS.output_graph, frozen_graph_def),
+              ('optimized', base_name + '_optimized.pb', optimized_graph_def)]
+  if FLAGS.export_quantized_graph:
+    quantized_graph_def = quantize_graph_weights(
+        optimized_graph_def, input_node_name, FLAGS.final_tensor_name)
+    if quantized_graph_def is not None:
+      variants.append(('quantized', base_name + '_quantized.pb',
+                       quantized_graph_def))
+
+  report = []
+  for name, file_name, graph_def in variants:
+    if name != 'frozen':
+      with gfile.FastGFile(file_name, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    result = evaluate_graph(graph_def, image_lists, FLAGS.image_dir, sess,
+                            jpeg_data_tensor, decoded_image_tensor, model_info)
+    result['variant'] = name
+    result['file'] = file_name
+    result['size_kb'] = gfile.Stat(file_name).length / 1024.0
+    report.append(result)
+    tf.logging.info('%-10s accuracy = %5.1f%%  latency p50 = %6.2f ms  '
+                    'p95 = %6.2f ms  size = %8.1f KB  (N=%d)' %
+                    (name, result['accuracy'], result['latency_p50_ms'],
+                     result['latency_p95_ms'], result['size_kb'],
+                     result['test_images']))
+
+  # Recommend the fastest variant that keeps the accuracy of the frozen graph
+  min_accuracy = report[0]['accuracy'] - FLAGS.export_accuracy_tolerance
+  candidates = [r for r in report if r['accuracy'] >= min_accuracy]
+  recommended = min(candidates, key=lambda r: r['latency_p50_ms'])
+  tf.logging.info('Recommended variant: %s (%s)' %
+                  (recommended['variant'], recommended['file']))
+
+  if FLAGS.export_report:
+    with gfile.FastGFile(FLAGS.export_report, 'w') as f:
+      f.write(json.dumps({'variants': report,
+                          'recommended': recommended['variant']}, indent=2))
+
+
 def prepare_file_system():
   # Setup the directory we'll write summaries to for TensorBoard
   if tf.gfile.Exists(FLAGS.summaries_dir):
@@ -1139,6 +1307,10 @@ def main(_):
     with gfile.FastGFile(FLAGS.output_labels, 'w') as f:
       f.write('\n'.join(image_lists.keys()) + '\n')
 
+    if FLAGS.export_inference_graphs:
+      export_inference_graphs(sess, image_lists, jpeg_data_tensor,
+                              decoded_image_tensor, model_info)
+
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -1322,5 +1494,38 @@ if __name__ == '__main__':
       takes 128x128 images. See https://research.googleblog.com/2017/06/mobilenets-open-source-models-for.html
       for more information on Mobilenet.\
       """)
+  parser.add_argument(
+      '--export_inference_graphs',
+      default=False,
+      help="""\
+      Whether to also write an inference optimized variant of the output graph
+      and report accuracy and latency of all variants on the test images.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--export_quantized_graph',
+      default=False,
+      help="""\
+      Whether to also write a variant with 8 bit quantized weights, when
+      exporting inference graphs.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--export_accuracy_tolerance',
+      type=float,
+      default=1.0,
+      help="""\
+      How many percentage points of test accuracy an exported variant may lose
+      against the frozen graph to still be recommended.\
+      """
+  )
+  parser.add_argument(
+      '--export_report',
+      type=str,
+      default='',
+      help='Where to save the JSON report comparing the exported graphs.'
+  )
   FLAGS, unparsed = parser.parse_known_args()
   tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)
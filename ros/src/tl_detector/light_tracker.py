@@ -0,0 +1,131 @@
+from styx_msgs.msg import TrafficLight
+import cv2
+import numpy as np
+
+
+class LightTrack(object):
+    def __init__(self, roi, anchor):
+        self.roi = roi
+        self.anchor = anchor
+        self.state = TrafficLight.UNKNOWN
+        self.signature = None
+        self.signature_roi = None
+        self.hits = 0
+        self.last_classified = 0.0
+        self.last_seen = 0.0
+
+
+class LightTracker(object):
+    """
+    Tracks traffic light ROIs across frames. The ROI of a light is smoothed over
+    frames and its side and lower margins are trimmed towards the projected light
+    while its state stays the same, whether reclassified or reused. A confident
+    state is reused as long as the crop looks unchanged, until max_interval
+    seconds have passed since the last classification. The signature is taken
+    from the fully trimmed ROI, which every crop of the track contains, so
+    trimming alone does not change it.
+    """
+    def __init__(self, smoothing=0.5, min_crop_factor=0.6, crop_step=0.1, change_threshold=12.0,
+                 max_interval=1.0, timeout=1.0, signature_size=(16, 16)):
+        self.smoothing = smoothing
+        self.min_crop_factor = min_crop_factor
+        self.crop_step = crop_step
+        self.change_threshold = change_threshold
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.signature_size = signature_size
+        self.tracks = {}
+        self.reused = 0
+        self.classified = 0
+
+    """
+    Get ROI of a light for the current frame
+    :param key: light identifier
+    :param roi: (x1, y1, x2, y2) ROI estimated from the current projection
+    :param anchor: (x, y) projected position of the light inside roi
+    :param now: frame time in seconds
+    :return: smoothed and tightened (x1, y1, x2, y2) ROI
+    """
+    def get_roi(self, key, roi, anchor, now):
+        roi = np.array(roi, dtype=np.float64)
+        anchor = np.array(anchor, dtype=np.float64)
+        track = self.tracks.get(key)
+        if track is None or now - track.last_seen > self.timeout:
+            track = LightTrack(roi, anchor)
+            self.tracks[key] = track
+        else:
+            track.roi = self.smoothing * track.roi + (1.0 - self.smoothing) * roi
+            track.anchor = self.smoothing * track.anchor + (1.0 - self.smoothing) * anchor
+        track.last_seen = now
+
+        # Trim side and lower margins towards the light the longer the track is stable. The upper
+        # margin is tight already, so the top lamp stays inside the ROI.
+        track.signature_roi = self.trim_roi(track, self.min_crop_factor)
+        return self.trim_roi(track, max(self.min_crop_factor, 1.0 - track.hits * self.crop_step))
+
+    # Returns ROI of a track with side and lower margins scaled by factor towards the anchor
+    def trim_roi(self, track, factor):
+        x1, y1, x2, y2 = track.roi
+        anchor_x, anchor_y = track.anchor
+        return (anchor_x + (x1 - anchor_x) * factor, y1,
+                anchor_x + (x2 - anchor_x) * factor, anchor_y + (y2 - anchor_y) * factor)
+
+    """
+    Get signature of a crop over the fully trimmed ROI of its light
+    :param key: light identifier
+    :param crop: crop of the ROI returned by get_roi
+    :param origin: (x, y) position of the crop's top left corner in ROI coordinates
+    :return: signature
+    """
+    def get_signature(self, key, crop, origin):
+        track = self.tracks.get(key)
+        if track is not None and track.signature_roi is not None:
+            x1, y1, x2, y2 = track.signature_roi
+            x1 = max(0, int(x1) - origin[0])
+            y1 = max(0, int(y1) - origin[1])
+            x2 = min(crop.shape[1], int(x2) - origin[0])
+            y2 = min(crop.shape[0], int(y2) - origin[1])
+            if x2 > x1 and y2 > y1:
+                crop = crop[y1:y2, x1:x2]
+        return cv2.resize(crop, self.signature_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    """
+    Get tracked state of a light, if its crop does not need to be classified again
+    :param key: light identifier
+    :param signature: signature of the current crop
+    :param now: frame time in seconds
+    :return: tracked state, None if the crop needs to be classified
+    """
+    def get_state(self, key, signature, now):
+        track = self.tracks.get(key)
+        if track is None or track.signature is None or track.state == TrafficLight.UNKNOWN:
+            return None
+        if now - track.last_classified > self.max_interval:
+            return None
+        if np.mean(np.abs(signature - track.signature)) > self.change_threshold:
+            return None
+        self.reused += 1
+        track.hits += 1
+        return track.state
+
+    def update(self, key, signature, state, now):
+        self.classified += 1
+        track = self.tracks.get(key)
+        if track is None:
+            return
+        if state == track.state and state != TrafficLight.UNKNOWN:
+            track.hits += 1
+        else:
+            track.hits = 0
+        track.state = state
+        track.signature = signature
+        track.last_classified = now
+
+    # Whether a light has a track with a known state
+    def is_confident(self, key):
+        track = self.tracks.get(key)
+        return track is not None and track.state != TrafficLight.UNKNOWN
+
+    def prune(self, now):
+        for key in [key for key, track in self.tracks.items() if now - track.last_seen > self.timeout]:
+            del self.tracks[key]
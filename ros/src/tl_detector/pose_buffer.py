@@ -0,0 +1,69 @@
+import threading
+import numpy as np
+import tf
+
+
+class PoseBuffer(object):
+    """
+    Ring buffer of recent vehicle poses, which answers pose queries for a given
+    time stamp by interpolating in between the two closest poses.
+    """
+    def __init__(self, size=50):
+        self.lock = threading.Lock()
+        self.stamps = np.zeros(size)
+        self.positions = np.zeros((size, 3))
+        self.orientations = np.zeros((size, 4))
+        self.size = size
+        self.count = 0
+        self.head = 0
+
+    def add_pose(self, pose_stamped):
+        position = pose_stamped.pose.position
+        orientation = pose_stamped.pose.orientation
+        with self.lock:
+            self.stamps[self.head] = pose_stamped.header.stamp.to_sec()
+            self.positions[self.head] = (position.x, position.y, position.z)
+            self.orientations[self.head] = (orientation.x, orientation.y, orientation.z, orientation.w)
+            self.head = (self.head + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    """
+    Get pose at the given time
+    :param stamp: rospy.Time to get the pose for (latest pose if None or zero)
+    :return: (translation, rotation quaternion) tuple, None if no pose has been added yet
+    """
+    def lookup(self, stamp=None):
+        with self.lock:
+            if self.count == 0:
+                return None
+            order = (np.arange(self.head - self.count, self.head)) % self.size
+            stamps = self.stamps[order]
+            positions = self.positions[order]
+            orientations = self.orientations[order]
+
+        # Poses are not extrapolated, out of range stamps get the closest pose
+        t = stamp.to_sec() if stamp else 0.0
+        if t <= 0.0 or t >= stamps[-1]:
+            return positions[-1], orientations[-1]
+        if t <= stamps[0]:
+            return positions[0], orientations[0]
+
+        ind = np.searchsorted(stamps, t)
+        dt = stamps[ind] - stamps[ind - 1]
+        fraction = (t - stamps[ind - 1]) / dt if dt > 0 else 1.0
+        position = positions[ind - 1] + fraction * (positions[ind] - positions[ind - 1])
+        orientation = tf.transformations.quaternion_slerp(orientations[ind - 1], orientations[ind], fraction)
+        return position, orientation
+
+    """
+    Get transformation from world into vehicle coordinates at the given time
+    :param stamp: rospy.Time to get the transformation for (latest if None or zero)
+    :return: 4x4 transformation matrix, None if no pose has been added yet
+    """
+    def get_world_to_base(self, stamp=None):
+        pose = self.lookup(stamp)
+        if pose is None:
+            return None
+        trans_mat = tf.transformations.translation_matrix(pose[0])
+        rot_mat = tf.transformations.quaternion_matrix(pose[1])
+        return np.linalg.inv(np.dot(trans_mat, rot_mat))
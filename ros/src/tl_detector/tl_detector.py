@@ -3,20 +3,36 @@ import rospy
 from std_msgs.msg import Int32
 from geometry_msgs.msg import PoseStamped, Pose
 from styx_msgs.msg import TrafficLightArray, TrafficLight
-from styx_msgs.msg import Lane
-from sensor_msgs.msg import Image
+from styx_msgs.msg import Lane, RegionImage
+from sensor_msgs.msg import Image, RegionOfInterest
 from cv_bridge import CvBridge
 from light_classification.tl_classifier import TLClassifier
-import os
-import tf
-import cv2
+from light_classification.image_sink import ImageSink
+from light_classification.result_cache import ResultCache, DEFAULT_MAX_SIZE, DEFAULT_TTL, DEFAULT_MAX_DISTANCE
+from light_classification.color_cascade import ColorCascade
+from camera_model import CameraModel
+from pose_buffer import PoseBuffer
+from frame_scheduler import FrameScheduler
+from light_tracker import LightTracker
+from light_classification.stage_timer import StageTimer
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from cpu_affinity import parse_cpus, set_cpu_affinity
+import tensorflow as tf
+import threading
+import traceback
 import yaml
-import math
 import numpy as np
+from scipy.spatial import cKDTree
 
 # TODO: Move this to config file
 STATE_COUNT_THRESHOLD = 3
 
+# Interval in seconds in between frame statistics log lines
+FRAME_STATS_INTERVAL = 10.0
+
+# Light states ordered from least to most restrictive, used to break ties when fusing states
+STATE_PRIORITY = [TrafficLight.GREEN, TrafficLight.YELLOW, TrafficLight.RED]
+
 '''
 /vehicle/traffic_lights provides you with the location of the traffic light in 3D map space and
 helps you acquire an accurate ground truth data source for the traffic light
@@ -33,19 +49,40 @@ class TLDetector(object):
 
         # Setup buffers
         self.pose = None
+        self.pose_buffer = PoseBuffer()
         self.waypoints = None
+        self.waypoint_tree = None
         self.camera_image = None
+        self.camera_offset = (0, 0)
         self.stop_lines = self.config['stop_line_positions']
         self.lights = []
+        self.light_keys = []
+        self.light_positions = np.zeros((0, 2))
+        self.light_table = {}
+
+        # Setup latest frame buffer, which is consumed by the inference worker
+        self.frame_cond = threading.Condition()
+        self.pending_frame = None
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.frames_processed = 0
+        self.last_result_age = 0.0
+        self.last_stats_time = 0.0
 
         # Setup subscribers/publishers
         sub1 = rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
         sub2 = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
         sub3 = rospy.Subscriber('/vehicle/traffic_lights', TrafficLightArray, self.traffic_cb)
-        sub6 = rospy.Subscriber('/image_color', Image, self.image_cb)
+        sub6 = rospy.Subscriber('/image_color', Image, self.image_cb, queue_size=1)
+        sub7 = rospy.Subscriber('/image_color_roi', RegionImage, self.region_image_cb, queue_size=1)
         self.upcoming_red_light_pub = rospy.Publisher('/traffic_waypoint', Int32, queue_size=1)
+        self.roi_request_pub = rospy.Publisher('/image_roi_request', RegionOfInterest, queue_size=1)
+        self.diagnostics_pub = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
         self.bridge = CvBridge()
 
+        # Setup per stage latency measurement
+        self.stage_timer = StageTimer(rospy.get_param('~enable_profiling', True))
+
         # Setup classifier
         model = \
             {
@@ -54,10 +91,11 @@ class TLDetector(object):
                 'input_depth': 3,
                 'resized_input_tensor_name': "input:0",
                 'output_tensor_name': "final_result:0",
-                'model_file_name': "light_classification/graph.pb",
+                'model_file_name': rospy.get_param('~model_file_name', "light_classification/graph.pb"),
                 'labels_file_name': "light_classification/labels.txt",
                 'input_mean': 127.5,
-                'input_std': 127.5
+                'input_std': 127.5,
+                'in_graph_preprocessing': rospy.get_param('~in_graph_preprocessing', False)
             }
         mapping = \
             {
@@ -66,7 +104,42 @@ class TLDetector(object):
                 'yellow': TrafficLight.YELLOW,
                 'red': TrafficLight.RED
             }
-        self.light_classifier = TLClassifier(model, mapping, False)
+        self.image_sink = ImageSink(
+            max_queue_size=rospy.get_param('~image_queue_size', 32),
+            drop_policy=rospy.get_param('~image_drop_policy', 'newest'),
+            image_format=rospy.get_param('~image_format', 'png'),
+            png_compression=rospy.get_param('~png_compression', 3),
+            jpeg_quality=rospy.get_param('~jpeg_quality', 90),
+            log_error=rospy.logerr)
+
+        # Keep inference off the cores of other nodes, TF thread pools and the worker inherit the affinity
+        inference_cpus = parse_cpus(rospy.get_param('~inference_cpus', ''))
+        if inference_cpus:
+            set_cpu_affinity(inference_cpus)
+            rospy.loginfo('Pinned traffic light inference to cpus %s', inference_cpus)
+        session_config = tf.ConfigProto(
+            intra_op_parallelism_threads=rospy.get_param('~intra_op_threads', 0),
+            inter_op_parallelism_threads=rospy.get_param('~inter_op_threads', 0))
+        # Near-identical crops reuse the cached result instead of running inference
+        self.result_cache = None
+        if rospy.get_param('~result_cache_size', DEFAULT_MAX_SIZE) > 0:
+            self.result_cache = ResultCache(
+                max_size=rospy.get_param('~result_cache_size', DEFAULT_MAX_SIZE),
+                ttl=rospy.get_param('~result_cache_ttl', DEFAULT_TTL),
+                max_distance=rospy.get_param('~result_cache_max_distance', DEFAULT_MAX_DISTANCE))
+        # Obvious crops are settled by their color, only ambiguous ones reach the network. Off by default,
+        # enable per deployment once the logged agreement with the network justifies it
+        self.color_cascade = None
+        if rospy.get_param('~color_cascade', False):
+            self.color_cascade = ColorCascade(
+                min_saturation=rospy.get_param('~cascade_min_saturation', 120),
+                min_value=rospy.get_param('~cascade_min_value', 180),
+                min_lit_fraction=rospy.get_param('~cascade_min_lit_fraction', 0.003),
+                max_unlit_fraction=rospy.get_param('~cascade_max_unlit_fraction', 0.0005),
+                dominance_ratio=rospy.get_param('~cascade_dominance_ratio', 10.0),
+                verify_interval=rospy.get_param('~cascade_verify_interval', 10))
+        self.light_classifier = TLClassifier(model, mapping, False, self.image_sink, self.stage_timer, session_config,
+                                             self.result_cache, self.color_cascade, rospy.loginfo)
         self.state = TrafficLight.UNKNOWN
         self.last_state = TrafficLight.UNKNOWN
         self.last_wp = -1
@@ -78,16 +151,40 @@ class TLDetector(object):
         self.img_size = (self.config['camera_info']['image_width'], self.config['camera_info']['image_height'])
         self.focal_length = (self.config['camera_info']['focal_length_x'], self.config['camera_info']['focal_length_y'])
         self.bounds_base = ((-3500,-1000),(3500,6000)) #((-1600, -1200), (1600, 5200))
+        self.camera_model = CameraModel(self.img_size, self.focal_length)
+        self.light_tracker = LightTracker()
         self.has_image = False
-        self.listener = tf.TransformListener()
+
+        # Setup region requests, camera only sends the part of the image around upcoming lights
+        self.request_roi = rospy.get_param('~request_roi', True)
+        self.roi_margin = rospy.get_param('~roi_margin', 64)
+        self.next_roi = None  # Region to request after the current frame, None for the full image
+        self.requested_roi = None
+
+        # Setup frame scheduling
+        self.frame_scheduler = FrameScheduler(
+            min_rate=rospy.get_param('~min_classification_rate', 2.0),
+            max_rate=rospy.get_param('~max_classification_rate', 30.0),
+            near_dist=rospy.get_param('~near_stop_line_distance', 20.0),
+            far_dist=rospy.get_param('~far_stop_line_distance', 100.0))
 
         # Setup simulator workaround
         self.workaround_sim = False
         if self.workaround_sim:
             self.loop()
         else:
+            worker = threading.Thread(target=self.process_frames, name='tl_detector_worker')
+            worker.daemon = True
+            worker.start()
             rospy.spin()
 
+            # Wake up waiting worker, and let it finish its current frame before the classifier goes away
+            with self.frame_cond:
+                self.frame_cond.notify_all()
+            worker.join()
+        self.light_classifier.close()
+        self.image_sink.close()
+
     # Workaround loop
     def loop(self):
         rate = rospy.Rate(10)
@@ -105,49 +202,186 @@ class TLDetector(object):
             rate.sleep()
 
     def pose_cb(self, msg):
+        self.pose_buffer.add_pose(msg)
         self.pose = msg
 
     def waypoints_cb(self, waypoints):
+        # Index waypoint coordinates once, so closest waypoint queries don't scan the whole track
+        waypoints_xyz = np.array([[wp.pose.pose.position.x, wp.pose.pose.position.y, wp.pose.pose.position.z]
+                                  for wp in waypoints.waypoints], dtype=np.float64)
+        self.waypoint_tree = cKDTree(waypoints_xyz)
         self.waypoints = waypoints
+        self.update_light_table(self.lights)
 
     def traffic_cb(self, msg):
         self.lights = msg.lights
 
+        # Light positions are static, so only the state needs to be refreshed usually
+        light_keys = [self.get_light_key(light) for light in msg.lights]
+        if light_keys != self.light_keys:
+            self.light_keys = light_keys
+            self.light_positions = np.array(light_keys, dtype=np.float64).reshape(-1, 2)
+            self.update_light_table(msg.lights)
+
     """
-    Identifies red lights in the incoming camera image and publishes the index
-    of the waypoint closest to the red light's stop line to /traffic_waypoint
+    Stores the incoming camera image for the inference worker. Only the newest
+    frame is kept, a frame which has not been picked up yet is dropped.
     Args:
     msg (Image): image from car-mounted camera
     """
     def image_cb(self, msg):
+        self.add_frame(msg, (0, 0))
+
+    """
+    Stores the incoming region of the camera image, sent instead of the full
+    image while a region is requested
+    Args:
+    msg (RegionImage): part of the image from car-mounted camera
+    """
+    def region_image_cb(self, msg):
+        self.add_frame(msg.image, (msg.roi.x_offset, msg.roi.y_offset))
+
+    def add_frame(self, image, offset):
         if not self.workaround_sim:
+            with self.frame_cond:
+                if self.pending_frame is not None:
+                    self.frames_dropped += 1
+                self.pending_frame = (image, offset, rospy.get_time())
+                self.frames_received += 1
+                self.frame_cond.notify()
+
+    # Inference worker loop
+    def process_frames(self):
+        while not rospy.is_shutdown():
+            with self.frame_cond:
+                while self.pending_frame is None and not rospy.is_shutdown():
+                    # No timeout, a timed wait polls on Python 2 and would delay frames by up to 50 ms
+                    self.frame_cond.wait()
+                if self.pending_frame is None:
+                    break
+                msg, offset, receive_time = self.pending_frame
+                self.pending_frame = None
+
+            try:
+                self.process_frame(msg, offset)
+            except Exception:
+                # Keep the worker alive, a single bad frame must not stop /traffic_waypoint
+                rospy.logerr('Failed to process camera frame:\n%s', traceback.format_exc())
+                continue
+
+            now = rospy.get_time()
+            self.frames_processed += 1
+            self.last_result_age = now - receive_time
+            if now - self.last_stats_time >= FRAME_STATS_INTERVAL:
+                self.last_stats_time = now
+                rospy.loginfo('Frames received: %d, dropped: %d, processed: %d, skipped: %.1f%%, result age: %.3f s, '
+                              'lights classified: %d, reused from track: %d',
+                              self.frames_received, self.frames_dropped, self.frames_processed,
+                              100.0 * self.frame_scheduler.get_skip_ratio(), self.last_result_age,
+                              self.light_tracker.classified, self.light_tracker.reused)
+                if self.result_cache is not None:
+                    rospy.loginfo('Result cache hits: %d, misses: %d, hit rate: %.1f%%',
+                                  self.result_cache.hits, self.result_cache.misses,
+                                  100.0 * self.result_cache.get_hit_rate())
+                if self.color_cascade is not None:
+                    rospy.loginfo('Color cascade settled: %d, passed: %d, verified: %d, agreement: %.1f%%',
+                                  self.color_cascade.settled, self.color_cascade.passed,
+                                  self.color_cascade.verified, 100.0 * self.color_cascade.get_agreement())
+                self.publish_stage_timings()
+
+    # Logs and publishes latency percentiles of all pipeline stages
+    def publish_stage_timings(self):
+        if not self.stage_timer.enabled:
+            return
+        status = DiagnosticStatus(level=DiagnosticStatus.OK, name='tl_detector: pipeline latency',
+                                  hardware_id='tl_detector')
+        timings = []
+        for name, count, (p50, p95, p99) in self.stage_timer.get_percentiles():
+            status.values.append(KeyValue(name + ' p50 [ms]', '%.2f' % (p50 * 1000.0)))
+            status.values.append(KeyValue(name + ' p95 [ms]', '%.2f' % (p95 * 1000.0)))
+            status.values.append(KeyValue(name + ' p99 [ms]', '%.2f' % (p99 * 1000.0)))
+            timings.append('%s %.1f/%.1f/%.1f' % (name, p50 * 1000.0, p95 * 1000.0, p99 * 1000.0))
+        rospy.loginfo('Stage latency p50/p95/p99 [ms]: %s', ', '.join(timings))
+
+        diagnostics = DiagnosticArray()
+        diagnostics.header.stamp = rospy.Time.now()
+        diagnostics.status.append(status)
+        self.diagnostics_pub.publish(diagnostics)
+
+    """
+    Requests the camera to only send the given region of the image
+    :param roi: (x1, y1, x2, y2) region in full image coordinates, None to request full images
+    """
+    def publish_roi_request(self, roi):
+        if not self.request_roi or (roi is None and self.requested_roi is None):
+            return
+        msg = RegionOfInterest()
+        if roi is not None:
+            # Leave room for the light moving until the next frame
+            x1 = max(0, int(roi[0]) - self.roi_margin)
+            y1 = max(0, int(roi[1]) - self.roi_margin)
+            x2 = min(self.img_size[0], int(roi[2]) + self.roi_margin)
+            y2 = min(self.img_size[1], int(roi[3]) + self.roi_margin)
+            msg = RegionOfInterest(x_offset=x1, y_offset=y1, width=x2 - x1, height=y2 - y1)
+        self.roi_request_pub.publish(msg)
+        self.requested_roi = roi
+
+    def publish_light_wp(self, light_wp):
+        with self.stage_timer.stage('publish'):
+            self.upcoming_red_light_pub.publish(Int32(light_wp))
+
+    """
+    Identifies red lights in the camera image and publishes the index
+    of the waypoint closest to the red light's stop line to /traffic_waypoint
+    Args:
+    msg (Image): image from car-mounted camera
+    offset (tuple): position of the image inside the full camera image
+    """
+    def process_frame(self, msg, offset=(0, 0)):
+        # Classify only with a stop line ahead, the closer the more often
+        stop_line_dist = self.get_upcoming_stop_line_distance(self.pose.pose) if self.pose else None
+        if self.frame_scheduler.should_process(rospy.get_time(), stop_line_dist):
             # Signal eventual traffic lights
             self.has_image = True
             self.camera_image = msg
+            self.camera_offset = offset
+            self.next_roi = None
             light_wp, state = self.process_traffic_lights()
+            self.publish_roi_request(self.next_roi)
+        elif stop_line_dist is None:
+            # Nothing to detect, skip image processing
+            light_wp, state = -1, TrafficLight.UNKNOWN
+            self.publish_roi_request(None)
+        else:
+            # Classification is not due yet, keep the last stable result but follow the lights with the region
+            self.publish_light_wp(self.last_wp)
+            lights = self.get_closest_traffic_lights(self.pose.pose)
+            light_projections = self.project_traffic_light_to_view(lights, msg.header.stamp) if lights else []
+            self.publish_roi_request(self.get_roi_request(light_projections))
+            return
+
+        '''
+        Publish upcoming red lights at camera frequency.
+        Each predicted state has to occur `STATE_COUNT_THRESHOLD` number
+        of times till we start using it. Otherwise the previous stable state is
+        used.
+        '''
+        if self.state != state:
+            self.state_count = 0
+            self.state = state
+        elif self.state_count >= STATE_COUNT_THRESHOLD:
+            self.last_state = self.state
+            light_wp = light_wp if state == TrafficLight.RED else -1
+            self.last_wp = light_wp
+            self.publish_light_wp(light_wp)
+        else:
+            self.publish_light_wp(self.last_wp)
 
-            '''
-            Publish upcoming red lights at camera frequency.
-            Each predicted state has to occur `STATE_COUNT_THRESHOLD` number
-            of times till we start using it. Otherwise the previous stable state is
-            used.
-            '''
-            if self.state != state:
-                self.state_count = 0
-                self.state = state
-            elif self.state_count >= STATE_COUNT_THRESHOLD:
-                self.last_state = self.state
-                light_wp = light_wp if state == TrafficLight.RED else -1
-                self.last_wp = light_wp
-                self.upcoming_red_light_pub.publish(Int32(light_wp))
-            else:
-                self.upcoming_red_light_pub.publish(Int32(self.last_wp))
-
-            if not light_wp == -1:
-                #rospy.loginfo("Currently detected red light at ind {}".format(self.last_wp))
-                pass
+        if not light_wp == -1:
+            #rospy.loginfo("Currently detected red light at ind {}".format(self.last_wp))
+            pass
 
-            self.state_count += 1
+        self.state_count += 1
 
     """
     Get eucledian distance between two point
@@ -159,34 +393,37 @@ class TLDetector(object):
     def get_distance(first, second):
         return np.linalg.norm(first - second)
 
+    """
+    Wraps the pixel buffer of an image message without converting the whole frame
+    :param msg: sensor_msgs/Image to wrap
+    :return: HxWx3 rgb view onto msg.data (falls back to a converted copy for other encodings)
+    """
+    def get_rgb_view(self, msg):
+        if msg.encoding in ('rgb8', 'bgr8'):
+            rows = np.frombuffer(msg.data, dtype=np.uint8).reshape(msg.height, msg.step)
+            view = rows[:, :msg.width * 3].reshape(msg.height, msg.width, 3)
+            return view if msg.encoding == 'rgb8' else view[:, :, ::-1]
+        return self.bridge.imgmsg_to_cv2(msg, "rgb8")
+
     def dump_frame(self, frame_image, x1, y1, x2, y2, color):
         if len(self.img_dump_dir) > 0:
-            if not os.path.exists(self.img_dump_dir):
-                os.makedirs(self.img_dump_dir)
-            bgr = cv2.cvtColor(frame_image, cv2.COLOR_RGB2BGR)
-            cv2.rectangle(bgr, (x1, y1), (x2, y2), color)
             self.img_count = self.img_count + 1
-            filename = self.img_dump_dir + "/cvimg-%02i.png" % self.img_count
-            cv2.imwrite(filename, bgr)
+            filename = self.img_dump_dir + "/cvimg-%02i" % self.img_count
+            self.image_sink.write(filename, frame_image, ((x1, y1), (x2, y2), color))
 
     """
     Identifies the closest path waypoint to the given position
-    https://en.wikipedia.org/wiki/Closest_pair_of_points_problem
+    https://en.wikipedia.org/wiki/K-d_tree
     Args:
-    pose (Pose): position to match a waypoint to
+    pose (np.array): x, y, z position to match a waypoint to
     Returns:
     int: index of the closest waypoint in self.waypoints
     """
     def get_closest_waypoint_xyz(self, pose):
-        min_ind = None
-        min_dist = 1e+100
-        for ind, wp in enumerate(self.waypoints.waypoints):
-            d = self.get_distance(pose, np.array([wp.pose.pose.position.x, wp.pose.pose.position.y,
-                                                  wp.pose.pose.position.z]))
-            if d < min_dist:
-                min_ind = ind
-                min_dist = d
-        return min_ind
+        if self.waypoint_tree is None:
+            return None
+        _, ind = self.waypoint_tree.query(pose)
+        return int(ind)
 
     def get_closest_waypoint(self, pose):
         return self.get_closest_waypoint_xyz(np.array([pose.position.x, pose.position.y, pose.position.z]))
@@ -196,17 +433,41 @@ class TLDetector(object):
     :return: List of traffic lights in vicinity, sorted by distance
     """
     def get_closest_traffic_lights(self, pose, detection_distance=100):
-        if not self.lights:
+        lights = self.lights
+        light_positions = self.light_positions
+        if not lights:
+            return None
+        if len(lights) != len(light_positions):
+            # Set of lights is just being replaced
+            return []
+        position_arr = np.array([pose.position.x, pose.position.y])
+        dists = np.linalg.norm(light_positions - position_arr, axis=1)
+        order = np.argsort(dists)
+        return [lights[ind] for ind in order[dists[order] < detection_distance]]
+
+    """
+    :param pose: vehicle pose
+    :return: distance to the closest stop line ahead of the vehicle (None if no light is in range)
+    """
+    def get_upcoming_stop_line_distance(self, pose):
+        lights = self.get_closest_traffic_lights(pose)
+        if not lights:
             return None
+
         position_arr = np.array([pose.position.x, pose.position.y])
-        lights = []
-        for light in self.lights:
-            light_pose = np.array([light.pose.pose.position.x, light.pose.pose.position.y])
-            dist = self.get_distance(light_pose, position_arr)
-            if dist < detection_distance:
-                lights.append(light)
-        lights.sort(key=lambda l: self.get_distance(np.array([l.pose.pose.position.x, l.pose.pose.position.y]), position_arr))
-        return lights
+        q = pose.orientation
+        heading = np.array([1.0 - 2.0 * (q.y * q.y + q.z * q.z), 2.0 * (q.x * q.y + q.z * q.w)])
+
+        min_dist = None
+        for light in lights:
+            entry = self.light_table.get(self.get_light_key(light))
+            if entry:
+                offset = np.array(entry[0][:2]) - position_arr
+                if offset.dot(heading) > 0:
+                    dist = np.linalg.norm(offset)
+                    if min_dist is None or dist < min_dist:
+                        min_dist = dist
+        return min_dist
 
     def get_closest_stop_line(self, position, detection_distance=50):
         # Init variables for search
@@ -225,113 +486,158 @@ class TLDetector(object):
 
         return closest_stop_line
 
-    """Determines the current color of the traffic light
+    @staticmethod
+    def get_light_key(light):
+        return light.pose.pose.position.x, light.pose.pose.position.y
+
+    """
+    Maps every traffic light to its closest stop line and the waypoint closest to that stop line
+    :param lights: list of traffic lights to map
+    """
+    def update_light_table(self, lights):
+        if self.waypoint_tree is None:
+            return
+        light_table = {}
+        for light in lights:
+            stop_line = self.get_closest_stop_line(light.pose.pose.position)
+            if stop_line:
+                stop_line_position = np.array([stop_line[0], stop_line[1], 0])
+                light_table[self.get_light_key(light)] = (stop_line, self.get_closest_waypoint_xyz(stop_line_position))
+        self.light_table = light_table
+
+    """
+    :param light: traffic light to look up
+    :return: index of waypoint closest to the light's stop line (None if the light has no stop line)
+    """
+    def get_light_stop_line_wp(self, light):
+        entry = self.light_table.get(self.get_light_key(light))
+        return entry[1] if entry else None
+
+    """Determines the current color of all projected traffic lights with a single classifier batch
     Args:
-    light (TrafficLight): light to classify
+    light_projections (list): (TrafficLight, (x, y, scale)) tuples of lights to classify
     Returns:
-    int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+    list: ID of traffic light color (specified in styx_msgs/TrafficLight) for each light
     """
-    def get_light_state(self, light_projection):
+    def get_light_states(self, light_projections):
+        states = [TrafficLight.UNKNOWN] * len(light_projections)
+
         # Check if there is really an image
         if not self.has_image:
-            return TrafficLight.UNKNOWN
+            return states
 
-        # Convert image to OpenCv format
-        cv_image = self.bridge.imgmsg_to_cv2(self.camera_image, "rgb8")
+        # Wrap image buffer, only the crops get copied
+        with self.stage_timer.stage('convert'):
+            cv_image = self.get_rgb_view(self.camera_image)
 
         # Estimate bounds
-        proj = light_projection[1]
-        if proj[2] != 0:
-            x1 = max(0, min(int(proj[0] + self.bounds_base[0][0] * proj[2]), self.img_size[0] - 1))
-            y1 = max(0, min(int(proj[1] + self.bounds_base[0][1] * proj[2]), self.img_size[1] - 1))
-            x2 = max(0, min(int(proj[0] + self.bounds_base[1][0] * proj[2]), self.img_size[0] - 1))
-            y2 = max(0, min(int(proj[1] + self.bounds_base[1][1] * proj[2]), self.img_size[1] - 1))
-            self.dump_frame(cv_image, x1, y1, x2, y2, (255, 0, 0))
-
-            # Get classification from DNN
-            if abs(x2 - x1) > 32 and abs(y2 - y1) > 32:
-                return self.light_classifier.get_classification(cv_image[y1:y2, x1:x2], light_projection[0].state)
-        return TrafficLight.UNKNOWN
-
-    def project_traffic_light_to_view(self, lights):
-        # print("HS: listener")
-        # print(self.listener);
-        # print("HS: pose")
-        # print(self.pose);
-        # tf::StampedTransform transform;
-        t = self.listener.getLatestCommonTime("/world", "/base_link")
-        (trans, rot) = self.listener.lookupTransform("/world", "/base_link", t)
-
-        image_width = self.img_size[0]
-        image_height = self.img_size[1]
-        trans_mat = tf.transformations.translation_matrix(trans)
-        rot_mat = tf.transformations.quaternion_matrix(rot)
-        n = 1.0  # you may want to adjust this if you want to look closer
-        f = 100.0  # you may want to adjust this if you want to took further
-        t = image_height / (2 * self.focal_length[1])
-        b = -t
-        r = image_width / (2 * self.focal_length[0])
-        l = -r
-
-        # http://www.glprogramming.com/red/appendixf.html
-        # proj_mat = np.matrix([[ 2*n/(r-l), 0,         (r+l)/(r-l), 0           ],
-        #                      [ 0,         2*n/(t-b), (t+b)/(t-b), 0           ],
-        #                      [ 0,         0,        -(f+n)/(f-n), -2*f*n/(f-n)],
-        #                      [ 0,         0,        -1,           0           ]]);
-        proj_mat = np.array([[-(r + l) / (r - l), -2.0 * n / (r - l), 0.0, 0.0],
-                             [-(t + b) / (t - b), 0.0, 2.0 * n / (t - b), 0.0],
-                             [(f + n) / (f - n), 0.0, 0.0, -2.0 * f * n / (f - n)],
-                             [1.0, 0.0, 0.0, 0.0]])
-
-        # the camera is obviously looking upwards
-        al = 7.0 * math.pi / 180.0  # adjust the angle
-        cosa = math.cos(al)
-        sina = math.sin(al)
-        bl = 0.7 * math.pi / 180.0  # adjust the angle
-        cosb = math.cos(bl)
-        sinb = math.sin(bl)
-        rotlookat_mat = np.array([[cosa, 0.0, sina, 0.0],
-                                  [0.0, 1.0, 0.0, 0.0],
-                                  [-sina, 0.0, cosa, 0.0],
-                                  [0.0, 0.0, 0.0, 1.0]])
-        rotlookatz_mat = np.array([[cosb, -sinb, 0.0, 0.0],
-                                   [sinb, cosb, 0.0, 0.0],
-                                   [0.0, 0.0, 1.0, 0.0],
-                                   [0.0, 0.0, 0.0, 1.0]])
-        mat = rotlookatz_mat.dot(rotlookat_mat.dot(np.linalg.inv(np.dot(trans_mat, rot_mat))))
-        # mat = np.linalg.inv(np.dot(trans_mat, rot_mat))
-        # mat = proj_mat.dot(np.linalg.inv(np.dot(trans_mat, rot_mat)))
+        now = rospy.get_time()
+        with self.stage_timer.stage('crop'):
+            crops = []
+            crop_states = []
+            crop_inds = []
+            crop_keys = []
+            crop_signatures = []
+            for ind, (light, proj) in enumerate(light_projections):
+                if proj[2] != 0:
+                    # Track bounds across frames, tracked lights get tighter crops
+                    key = self.get_light_key(light)
+                    bounds = self.light_tracker.get_roi(key, (proj[0] + self.bounds_base[0][0] * proj[2],
+                                                              proj[1] + self.bounds_base[0][1] * proj[2],
+                                                              proj[0] + self.bounds_base[1][0] * proj[2],
+                                                              proj[1] + self.bounds_base[1][1] * proj[2]),
+                                                        (proj[0], proj[1]), now)
+                    x1 = max(0, min(int(bounds[0]), self.img_size[0] - 1))
+                    y1 = max(0, min(int(bounds[1]), self.img_size[1] - 1))
+                    x2 = max(0, min(int(bounds[2]), self.img_size[0] - 1))
+                    y2 = max(0, min(int(bounds[3]), self.img_size[1] - 1))
+                    origin = (x1, y1)
+
+                    # Image may only be a region of the camera image
+                    x1 -= self.camera_offset[0]
+                    x2 -= self.camera_offset[0]
+                    y1 -= self.camera_offset[1]
+                    y2 -= self.camera_offset[1]
+                    self.dump_frame(cv_image, x1, y1, x2, y2, (255, 0, 0))
+
+                    # Lights not completely inside the region are left for the next frame
+                    inside = x1 >= 0 and y1 >= 0 and x2 <= cv_image.shape[1] and y2 <= cv_image.shape[0]
+                    if inside and abs(x2 - x1) > 32 and abs(y2 - y1) > 32:
+                        crop = np.ascontiguousarray(cv_image[y1:y2, x1:x2])
+                        signature = self.light_tracker.get_signature(key, crop, origin)
+
+                        # Skip DNN as long as tracked light looks unchanged
+                        tracked_state = self.light_tracker.get_state(key, signature, now)
+                        if tracked_state is not None:
+                            states[ind] = tracked_state
+                        else:
+                            crops.append(crop)
+                            crop_states.append(light.state)
+                            crop_inds.append(ind)
+                            crop_keys.append(key)
+                            crop_signatures.append(signature)
+            self.light_tracker.prune(now)
+
+        # Get classification from DNN
+        if crops:
+            crop_results = self.light_classifier.get_classifications(crops, crop_states)
+            for ind, key, signature, state in zip(crop_inds, crop_keys, crop_signatures, crop_results):
+                self.light_tracker.update(key, signature, state, now)
+                states[ind] = state
+        return states
 
-        for light in lights:
-            transformed = mat.dot(
-                np.array([light.pose.pose.position.x, light.pose.pose.position.y, light.pose.pose.position.z, 1]))
-            projected = proj_mat.dot(transformed)
-            # print(proj_mat)
-            #                tansformed = self.pose.pose * light.pose.pose.position;
-            # print(mat);
-            # print(transformed)
-            # print(projected/projected[3])
-
-            projected = projected / projected[3]
-            # clip
-            if (-1 < projected[0] and 1 > projected[0] and
-                        -1 < projected[1] and 1 > projected[1] and
-                        -1 < projected[2] and 1 > projected[2]):
-                projx = projected[0] * image_width / 2.0 + image_width / 2.0
-                projy = -projected[1] * image_height / 2.0 + image_height / 2.0
-                projs = 1.0 / transformed[0]
-                # print("screenpos = %g %g scale = %g",
-                #      self.projx,
-                #      self.projy,
-                #      self.projs)
-                # else:
-                # print("out")
-                # light_pose = tf.Vector3Stamped()
-                # light_pose.vector.x = light.pose.pose.position.x
-                # light_pose.vector.y = light.pose.pose.position.y
-                # light_pose.vector.z = light.pose.pose.position.z
-                return light, (projx, projy, projs)
-        return None, (0, 0, 0)
+    """
+    Fuses the states of several signal heads into one state by majority vote
+    :param states: list of traffic light states
+    :return: fused state, ties are resolved towards the more restrictive state
+    """
+    @staticmethod
+    def fuse_light_states(states):
+        votes = [state for state in states if state in STATE_PRIORITY]
+        if not votes:
+            return TrafficLight.UNKNOWN
+        return max(STATE_PRIORITY, key=lambda state: (votes.count(state), STATE_PRIORITY.index(state)))
+
+    """
+    Get region of the camera image to request for the next frame, covering the untrimmed ROIs of all
+    projected lights. Only lights with a confident track are followed, others need the full image.
+    :param light_projections: list of (TrafficLight, (x, y, scale)) tuples
+    :return: (x1, y1, x2, y2) region in full image coordinates, None to request full images
+    """
+    def get_roi_request(self, light_projections):
+        roi = None
+        for light, proj in light_projections:
+            if proj[2] != 0:
+                if not self.light_tracker.is_confident(self.get_light_key(light)):
+                    return None
+                x1 = proj[0] + self.bounds_base[0][0] * proj[2]
+                y1 = proj[1] + self.bounds_base[0][1] * proj[2]
+                x2 = proj[0] + self.bounds_base[1][0] * proj[2]
+                y2 = proj[1] + self.bounds_base[1][1] * proj[2]
+                roi = (x1, y1, x2, y2) if roi is None else \
+                    (min(x1, roi[0]), min(y1, roi[1]), max(x2, roi[2]), max(y2, roi[3]))
+        return roi
+
+    """
+    Projects traffic lights into the camera image
+    :param lights: list of traffic lights to project
+    :param stamp: time the image was taken
+    :return: list of (TrafficLight, (x, y, scale)) tuples for all lights inside the view frustum
+    """
+    def project_traffic_light_to_view(self, lights, stamp):
+        # Get vehicle pose at the time the image was taken
+        with self.stage_timer.stage('pose_lookup'):
+            world_to_base = self.pose_buffer.get_world_to_base(stamp)
+        if world_to_base is None:
+            return []
+
+        # Project all lights at once
+        positions = [[light.pose.pose.position.x, light.pose.pose.position.y, light.pose.pose.position.z]
+                     for light in lights]
+        with self.stage_timer.stage('projection'):
+            visible, projections = self.camera_model.project(world_to_base, positions)
+        light_projections = [(lights[ind], tuple(proj)) for ind, proj in zip(visible, projections)]
+        return light_projections
 
 
     """
@@ -352,27 +658,25 @@ class TLDetector(object):
             if len(lights) > 0:
                 if self.workaround_sim:
                     # Forward ground truth from sim
-                    stop_line = self.get_closest_stop_line(lights[0].pose.pose.position)
-                    stop_line_position = np.array([stop_line[0], stop_line[1], 0])
-                    light_wp_ind = self.get_closest_waypoint_xyz(stop_line_position)
-                    return light_wp_ind, lights[0].state
+                    light_wp_ind = self.get_light_stop_line_wp(lights[0])
+                    if light_wp_ind is not None:
+                        return light_wp_ind, lights[0].state
                 else:
-                    # Get closest projected light in view
-                    light_projection = self.project_traffic_light_to_view(lights)
-
-                    if light_projection[0]:
-                        # Get state of light
-                        state = self.get_light_state(light_projection)
-
-                        # Get stop line closest to light
-                        stop_line = self.get_closest_stop_line(light_projection[0].pose.pose.position)
-
-                        if stop_line:
-                            stop_line_position = np.array([stop_line[0], stop_line[1], 0])
-
-                            # Get waypoint closest to stopline
-                            light_wp_ind = self.get_closest_waypoint_xyz(stop_line_position)
-                            return light_wp_ind, state
+                    # Get all projected lights in view
+                    light_projections = self.project_traffic_light_to_view(lights, self.camera_image.header.stamp)
+
+                    if light_projections:
+                        # Get state of all visible lights at once
+                        states = self.get_light_states(light_projections)
+                        self.next_roi = self.get_roi_request(light_projections)
+
+                        # Get waypoint closest to the stop line of the closest visible light
+                        light_wps = [self.get_light_stop_line_wp(light) for light, _ in light_projections]
+                        for light_wp_ind in light_wps:
+                            if light_wp_ind is not None:
+                                # Fuse states of all signal heads sharing that stop line
+                                return light_wp_ind, self.fuse_light_states(
+                                    [state for state, wp in zip(states, light_wps) if wp == light_wp_ind])
         return -1, TrafficLight.UNKNOWN
 
 
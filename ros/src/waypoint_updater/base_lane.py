@@ -0,0 +1,80 @@
+from geometry_msgs.msg import TwistStamped
+from styx_msgs.msg import Waypoint
+from scipy.spatial import cKDTree
+import numpy as np
+
+SEARCH_WPS_BEHIND = 5  # Number of waypoints behind the last position searched for the nearest waypoint
+SEARCH_WPS_AHEAD = 20  # Number of waypoints ahead of the last position searched for the nearest waypoint
+MAX_SEARCH_DIST = 5.0  # Distance in m from the nearest waypoint of the window beyond which the car is relocated
+
+
+class BaseLane(object):
+    """
+    Base waypoints as NumPy columns (x, y, z, v) plus their arc length. The
+    waypoint messages are never modified, only their poses are reused when
+    publishing waypoints with new velocities. The track is treated as a loop.
+    """
+    def __init__(self, waypoints):
+        self.poses = [wp.pose for wp in waypoints]
+        self.xyz = np.array([[wp.pose.pose.position.x, wp.pose.pose.position.y, wp.pose.pose.position.z]
+                             for wp in waypoints], dtype=np.float64)
+        self.v = np.array([wp.twist.twist.linear.x for wp in waypoints], dtype=np.float64)
+        self.tree = cKDTree(self.xyz)
+
+        # Arc length from the first waypoint to each waypoint, track closes from the last to the first one
+        segment_lengths = np.linalg.norm(np.diff(self.xyz, axis=0), axis=1)
+        self.s = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+        self.length = self.s[-1] + np.linalg.norm(self.xyz[0] - self.xyz[-1])
+
+    def __len__(self):
+        return len(self.xyz)
+
+    """
+    Get index of the waypoint nearest to the given position (ignoring heading). Only a small
+    window around the last index is searched, the whole track only if the car left that window.
+    :param position: position of the car
+    :param last_idx: index of the nearest waypoint of the previous search (-1 if unknown)
+    :return: index of the nearest waypoint
+    """
+    def get_nearest_idx(self, position, last_idx):
+        pos = np.array([position.x, position.y, position.z])
+        num_wps = len(self.xyz)
+        if last_idx >= 0 and num_wps > SEARCH_WPS_BEHIND + SEARCH_WPS_AHEAD:
+            window = np.arange(last_idx - SEARCH_WPS_BEHIND, last_idx + SEARCH_WPS_AHEAD + 1) % num_wps
+            dists = np.sum((self.xyz[window] - pos) ** 2, axis=1)
+            nearest = np.argmin(dists)
+            # Nearest waypoint at the window border or far off means localisation jumped
+            if 0 < nearest < len(window) - 1 and dists[nearest] <= MAX_SEARCH_DIST ** 2:
+                return int(window[nearest])
+        return int(self.tree.query(pos)[1])
+
+    # Returns distance along waypoints from wp1 forward to wp2, wrapping around the end of the track
+    def distance(self, wp1, wp2):
+        dist = self.s[wp2] - self.s[wp1]
+        return dist + self.length if wp2 < wp1 else dist
+
+    # Returns indices of count waypoints starting at start
+    def get_indices(self, start, count):
+        return np.arange(start, start + count) % len(self.xyz)
+
+    # Returns distances along waypoints from each of the given indices forward to target
+    def get_distances_to(self, indices, target):
+        dists = self.s[target] - self.s[indices]
+        dists[indices > target] += self.length
+        return dists
+
+    """
+    Creates waypoint messages sharing the cached poses
+    :param indices: indices of the waypoints
+    :param velocities: velocity of each waypoint
+    :return: list of new Waypoint messages
+    """
+    def create_waypoints(self, indices, velocities):
+        waypoints = []
+        for idx, velocity in zip(indices.tolist(), np.asarray(velocities, dtype=np.float64).tolist()):
+            waypoint = Waypoint()
+            waypoint.pose = self.poses[idx]
+            waypoint.twist = TwistStamped()
+            waypoint.twist.twist.linear.x = velocity
+            waypoints.append(waypoint)
+        return waypoints
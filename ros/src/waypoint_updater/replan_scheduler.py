@@ -0,0 +1,68 @@
+import threading
+import time
+
+
+class ReplanScheduler(object):
+    """
+    Decides when the waypoints get replanned. Callbacks request a replan for new
+    input, requests arriving before the planner woke up are coalesced into one.
+    Replanning happens at most with max_rate and, even without requests, at
+    least with min_rate (never if min_rate is 0).
+    """
+    def __init__(self, min_rate=1.0, max_rate=50.0):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.cond = threading.Condition()
+        self.request_time = None
+        self.last_time = 0.0
+        self.closed = False
+        self.requests = 0
+        self.replans = 0
+
+    """
+    Requests a replan
+    :param stamp: time stamp of the triggering input, passed through to the planner for measuring latency
+    """
+    def request(self, stamp):
+        with self.cond:
+            self.requests += 1
+            if self.request_time is None:
+                self.request_time = stamp
+                self.cond.notify()
+
+    """
+    Waits until the next replan is due, but never longer than max_wait, so the caller can check for shutdown
+    :param max_wait: maximum time in seconds to wait
+    :return: (whether a replan is due, stamp of the oldest coalesced request or None if not triggered by a request)
+    """
+    def wait(self, max_wait=0.5):
+        with self.cond:
+            give_up_time = time.time() + max_wait
+            while not self.closed:
+                now = time.time()
+                if self.request_time is not None:
+                    deadline = self.last_time + 1.0 / self.max_rate
+                elif self.min_rate > 0:
+                    deadline = self.last_time + 1.0 / self.min_rate
+                else:
+                    deadline = None
+                if deadline is not None and deadline <= now:
+                    break
+                if now >= give_up_time:
+                    return False, None
+                wake_time = give_up_time if deadline is None else min(deadline, give_up_time)
+                self.cond.wait(wake_time - now)
+            else:
+                return False, None
+
+            request_time = self.request_time
+            self.request_time = None
+            self.last_time = time.time()
+            self.replans += 1
+            return True, request_time
+
+    # Wakes up the planner for shutting down
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
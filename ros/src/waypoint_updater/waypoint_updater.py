@@ -6,8 +6,12 @@ from geometry_msgs.msg import Point
 from styx_msgs.msg import Lane, Waypoint
 from std_msgs.msg import Int32
 from geometry_msgs.msg import TwistStamped
+from base_lane import BaseLane
+from replan_scheduler import ReplanScheduler
 
-import math
+import collections
+import numpy as np
+import time
 
 '''
 This node will publish waypoints from the car's current position to some `x` distance ahead.
@@ -25,17 +29,22 @@ TODO (for Yousuf and Aaron): Stopline location for each traffic light.
 '''
 
 LOOKAHEAD_WPS = 200  # Number of waypoints we will publish. You can change this number
-
-
-# Tools
-def distance(a, b):
-    return math.sqrt((a.x - b.x) ** 2 + (a.y - b.y) ** 2 + (a.z - b.z) ** 2)
+LATENCY_REPORT_INTERVAL = 10.0  # Interval in seconds in between plan latency log lines
+LATENCY_WINDOW_SIZE = 500  # Number of latency samples the percentiles are computed from
 
 
 class WaypointUpdater(object):
     def __init__(self):
         rospy.init_node('waypoint_updater')
 
+        # Replan when new input arrives instead of polling
+        self.scheduler = ReplanScheduler(
+            min_rate=rospy.get_param('~min_replan_rate', 1.0),
+            max_rate=rospy.get_param('~max_replan_rate', 50.0))
+        rospy.on_shutdown(self.scheduler.close)
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW_SIZE)  # Input to published plan in seconds
+        self.last_report_time = time.time()
+
         rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
         rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
         rospy.Subscriber('/traffic_waypoint', Int32, self.traffic_cb)
@@ -45,8 +54,12 @@ class WaypointUpdater(object):
         self.final_waypoints_pub = rospy.Publisher('final_waypoints', Lane, queue_size=1)
 
         # Add other member variables you need below
-        self.base_waypoints = []
-        self.final_waypoints = []
+        self.base_lane = None
+        self.final_lane = None  # Base lane the final waypoints were planned on
+        self.final_waypoints = collections.deque()  # Planned waypoints, slid along as the car moves
+        self.final_wp_idx = -1  # Base waypoint index of the first final waypoint
+        self.constraint = None  # (light index, must brake) the velocity profile was planned for
+        self.brake_profile = None  # (start index, stop offset, velocity, light distance) of an active braking
         self.cur_pos = PoseStamped()
         self.cur_wp_idx = -1  # Index of wp we want to move to in the current loop
         self.last_wp_idx = -1  # Index of wp from the previous loop
@@ -60,14 +73,17 @@ class WaypointUpdater(object):
 
     def pose_cb(self, pose):
         self.cur_pos = pose
+        self.scheduler.request(self.get_stamp(pose.header))
 
     def waypoints_cb(self, lane):
-        # Simply assign waypoints from lane
-        self.base_waypoints = lane.waypoints
+        # Keep base waypoints as arrays, the messages themselves are never modified
+        self.base_lane = BaseLane(lane.waypoints)
+        self.scheduler.request(self.get_stamp(lane.header))
 
     def traffic_cb(self, msg):
-        # Callback for /traffic_waypoint message
+        # Callback for /traffic_waypoint message (has no header, so latency counts from reception)
         self.cur_light_idx = msg.data
+        self.scheduler.request(rospy.get_time())
 
     def obstacle_cb(self, msg):
         # TODO: Callback for /obstacle_waypoint message. We will implement it later
@@ -76,20 +92,68 @@ class WaypointUpdater(object):
     def velocity_cb(self, msg):
         # Callback for /current_velocity
         self.cur_vel = msg.twist.linear.x
-
-    def get_waypoint_velocity(self, waypoint):
-        return waypoint.twist.twist.linear.x
-
-    def set_waypoint_velocity(self, waypoints, waypoint, velocity):
-        waypoints[waypoint].twist.twist.linear.x = velocity
-
-    # Returns beeline distance along waypoints in between wp1 and wp2
-    def distance(self, waypoints, wp1, wp2):
-        dist = 0
-        for i in range(wp1, wp2 + 1):
-            dist += distance(waypoints[wp1].pose.pose.position, waypoints[i].pose.pose.position)
-            wp1 = i
-        return dist
+        self.scheduler.request(self.get_stamp(msg.header))
+
+    # Returns time stamp of a message header in seconds, the current time for unstamped messages
+    def get_stamp(self, header):
+        stamp = header.stamp.to_sec()
+        return stamp if stamp > 0 else rospy.get_time()
+
+    # Returns planned velocity of a base waypoint, its base velocity if it is not part of the plan
+    def get_waypoint_velocity(self, base_lane, idx):
+        if self.final_lane is base_lane:
+            offset = (idx - self.final_wp_idx) % len(base_lane)
+            if offset < len(self.final_waypoints):
+                return self.final_waypoints[offset].twist.twist.linear.x
+        return base_lane.v[idx]
+
+    """
+    Get planned velocities of base waypoints under the current velocity profile
+    :param base_lane: base lane
+    :param idxs: array of base waypoint indices
+    :return: array of velocities
+    """
+    def get_profile_velocities(self, base_lane, idxs):
+        if self.brake_profile is None:
+            # Full throttle
+            return np.full(len(idxs), self.max_velocity)
+
+        # Everything beyond traffic light is 0 velocity
+        start_idx, stop_offset, v, light_dist = self.brake_profile
+        velocities = np.zeros(len(idxs))
+        ramp = (idxs - start_idx) % len(base_lane) < stop_offset
+        if np.any(ramp):
+            # Gradually decrease velocity based on remaining distance to traffic light
+            # TODO Use better formula than linear decrease over whole distance
+            stop_idx = (start_idx + stop_offset) % len(base_lane)
+            velocities[ramp] = v * base_lane.get_distances_to(idxs[ramp], stop_idx) / light_dist
+        return velocities
+
+    """
+    Slides the final waypoints forward to start at the current waypoint, only waypoints which
+    were passed are dropped and only the new tail is created
+    :param base_lane: base lane
+    :param profile_changed: whether velocities of the kept waypoints need to be recomputed
+    """
+    def update_final_waypoints(self, base_lane, profile_changed):
+        advance = (self.cur_wp_idx - self.final_wp_idx) % len(base_lane)
+        if self.final_lane is not base_lane or advance >= len(self.final_waypoints):
+            # Plan from scratch, e.g. at start up or when localisation jumped
+            idxs = base_lane.get_indices(self.cur_wp_idx, LOOKAHEAD_WPS)
+            self.final_waypoints = collections.deque(
+                base_lane.create_waypoints(idxs, self.get_profile_velocities(base_lane, idxs)))
+        else:
+            for _ in range(advance):
+                self.final_waypoints.popleft()
+            if profile_changed:
+                idxs = base_lane.get_indices(self.cur_wp_idx, len(self.final_waypoints))
+                for waypoint, velocity in zip(self.final_waypoints,
+                                              self.get_profile_velocities(base_lane, idxs).tolist()):
+                    waypoint.twist.twist.linear.x = velocity
+            idxs = base_lane.get_indices(self.cur_wp_idx + len(self.final_waypoints), advance)
+            self.final_waypoints.extend(base_lane.create_waypoints(idxs, self.get_profile_velocities(base_lane, idxs)))
+        self.final_lane = base_lane
+        self.final_wp_idx = self.cur_wp_idx
 
     def kmph2mps(self, velocity_kmph):
         return (velocity_kmph * 1000.) / (60. * 60.)
@@ -97,81 +161,68 @@ class WaypointUpdater(object):
     def get_safe_breaking_distance(self, v, road_friction=1.2):
         return (v ** 2) / (2.0 * road_friction * 9.81)
 
+    # Logs percentiles of the latency from input message stamp to published plan
+    def report_latency(self):
+        now = time.time()
+        if now - self.last_report_time < LATENCY_REPORT_INTERVAL or not self.latencies:
+            return
+        self.last_report_time = now
+        p50, p95, p99 = np.percentile(np.array(self.latencies) * 1000.0, [50, 95, 99])
+        rospy.loginfo('Plan latency p50/p95/p99 [ms]: %.1f/%.1f/%.1f, replans: %d, requests: %d',
+                      p50, p95, p99, self.scheduler.replans, self.scheduler.requests)
+
     # Main loop
     def loop(self):
-        rate = rospy.Rate(10)
-
         while not rospy.is_shutdown():
-            if self.cur_pos.header.seq > 0 and len(self.base_waypoints) > 0:
-                max_index = len(self.base_waypoints)
-
-                if len(self.final_waypoints) > 0:
-                    # Final waypoints already exist so use as candidates for the next round
-                    waypoint_candidates = self.final_waypoints
-                else:
-                    # No Final waypoints so use the base waypoints
-                    waypoint_candidates = self.base_waypoints
+            due, request_time = self.scheduler.wait()
+            base_lane = self.base_lane
+            if due and self.cur_pos.header.seq > 0 and base_lane is not None:
+                max_index = len(base_lane)
 
-                # Find nearest base waypoint (ignore heading)
-                nearest_wp = min(
-                    waypoint_candidates,
-                    key=lambda wp, pos=self.cur_pos: distance(pos.pose.position, wp.pose.pose.position))
-
-                # Make the nearest waypoint to be the current one and get its index
-                self.cur_wp_idx = self.base_waypoints.index(nearest_wp)
-                #rospy.loginfo('current waypoint velocity %0.2f m/s', self.get_waypoint_velocity(nearest_wp))
+                # Make the nearest base waypoint to be the current one
+                self.cur_wp_idx = base_lane.get_nearest_idx(self.cur_pos.pose.position, self.last_wp_idx)
+                #rospy.loginfo('current waypoint velocity %0.2f m/s', self.get_waypoint_velocity(base_lane, self.cur_wp_idx))
 
                 # Generate & publish new final waypoints, if we moved
                 if self.cur_wp_idx != self.last_wp_idx or self.cur_light_idx != self.last_light_idx:
-                    del self.final_waypoints[:]
-                    for i in range(0, LOOKAHEAD_WPS):
-                        self.final_waypoints.append(self.base_waypoints[(self.cur_wp_idx + i) % max_index])
-
                     must_brake = False
                     final_light_idx = (self.cur_light_idx - self.cur_wp_idx) % max_index
                     # Check if traffic light is within lookahead distance
                     if self.cur_light_idx != -1 and final_light_idx < LOOKAHEAD_WPS:
                         v = self.cur_vel
                         min_break_dist = self.get_safe_breaking_distance(v)
-                        light_dist = self.distance(self.final_waypoints, 0, final_light_idx)
+                        light_dist = base_lane.distance(self.cur_wp_idx, self.cur_light_idx)
 
                         # Check if traffic light is within braking distance
                         if light_dist >= min_break_dist \
-                                or (light_dist == 0 and self.get_waypoint_velocity(self.final_waypoints[0]) < 1.0):
+                                or (light_dist == 0 and self.get_waypoint_velocity(base_lane, self.cur_wp_idx) < 1.0):
                             rospy.loginfo('Red traffic light within %d m... breaking', light_dist)
                             must_brake = True
                         else:
                             rospy.logwarn('Red traffic light within %d m... ignored', light_dist)
 
-                    if must_brake:
+                    # Velocity profile is only replanned when the constraint changes
+                    constraint = (self.cur_light_idx, must_brake)
+                    profile_changed = constraint != self.constraint
+                    if profile_changed:
+                        self.constraint = constraint
                         # Initiate breaking
-                        remaining_dist = 0
-                        self.set_waypoint_velocity(self.final_waypoints, LOOKAHEAD_WPS - 1, 0)
-                        for i in range(LOOKAHEAD_WPS - 2, -1, -1):
-                            if i >= final_light_idx - 5:
-                                # Everything beyond traffic light is 0 velocity
-                                self.set_waypoint_velocity(self.final_waypoints, i, 0)
-                            else:
-                                # Gradually decrease velocity based on remaining distance to traffic light
-                                # TODO Use better formula than linear decrease over whole distance
-                                remaining_dist += distance(self.final_waypoints[i].pose.pose.position, self.final_waypoints[i + 1].pose.pose.position)
-                                self.set_waypoint_velocity(self.final_waypoints, i, v * remaining_dist / light_dist)
-
-                    else:
-                        # Full throttle
-                        for i in range(0, len(self.final_waypoints)):
-                            self.set_waypoint_velocity(self.final_waypoints, i, self.max_velocity)
+                        self.brake_profile = (self.cur_wp_idx, final_light_idx - 5, v, light_dist) \
+                            if must_brake else None
+                    self.update_final_waypoints(base_lane, profile_changed)
 
                     # Publish planning
                     self.publish()
                     self.last_wp_idx = self.cur_wp_idx
                     self.last_light_idx = self.cur_light_idx
-            rate.sleep()
+                    if request_time is not None:
+                        self.latencies.append(rospy.get_time() - request_time)
+            self.report_latency()
 
     # Publish final waypoints
     def publish(self):
         lane = Lane()
-        lane.waypoints = self.final_waypoints
+        lane.waypoints = list(self.final_waypoints)
         self.final_waypoints_pub.publish(lane)
 
 